@@ -44,10 +44,40 @@ class GeomSettings(Settings):
 
 
 class TimingSettings(Settings):
-    def __init__(self, tRP, tRCD, tWR, tWTR, tREFI, tRFC, tFAW, tCCD, tRRD, tRC, tRAS):
+    # On memories with bank groups (DDR4), tCCD/tRRD/tWTR are the same bank group
+    # timings (_L) and tCCD_S/tRRD_S/tWTR_S the different bank groups timings.
+    def __init__(self, tRP, tRCD, tWR, tWTR, tREFI, tRFC, tFAW, tCCD, tRRD, tRC, tRAS,
+                 tCCD_S=None, tRRD_S=None, tWTR_S=None):
         self.set_attributes(locals())
 
 
+def get_rtw_latency(phy_settings):
+    """Minimal READ to WRITE command spacing (in sys clk cycles).
+
+    Read data has to be off the DQ bus before write data is driven: at the
+    SDRAM, a WRITE can follow a READ after CL + BL/2 + 2 - CWL clock cycles
+    (one cycle of bus turnaround only on SDR). READ and WRITE are issued on
+    rdphase and wrphase, and multi-phases PHYs enable their DQ/DQS outputs
+    up to one sys clk cycle before the write data (DQS preamble).
+    """
+    memtype = phy_settings.memtype
+    nphases = phy_settings.nphases
+    cwl = {
+        "SDR":   0,
+        "DDR":   1,
+        "LPDDR": 1,
+        "DDR2":  phy_settings.cl - 1,
+    }.get(memtype, phy_settings.cwl)
+    turnaround = 1 if memtype == "SDR" else 2
+    rtw = phy_settings.cl + max(burst_lengths[memtype]//2, 1) + turnaround - cwl
+    rtw += phy_settings.rdphase - phy_settings.wrphase
+    rtw = -(-rtw//nphases)
+    if nphases > 1:
+        rtw += 1
+    # never slower than the read_latency based turnaround
+    return max(min(rtw, phy_settings.read_latency), 1)
+
+
 def cmd_layout(address_width):
     return [
         ("valid",            1, DIR_M_TO_S),
@@ -55,6 +85,10 @@ def cmd_layout(address_width):
         ("we",               1, DIR_M_TO_S),
         ("addr", address_width, DIR_M_TO_S),
         ("lock",             1, DIR_S_TO_M), # only used internally
+        ("read_hold",        1, DIR_M_TO_S), # only used internally
+        ("write_hold",       1, DIR_M_TO_S), # only used internally
+        ("read_next_hold",   1, DIR_M_TO_S), # only used internally
+        ("write_next_hold",  1, DIR_M_TO_S), # only used internally
 
         ("wdata_ready",      1, DIR_S_TO_M),
         ("rdata_valid",      1, DIR_S_TO_M)
@@ -83,11 +117,14 @@ class LiteDRAMInterface(Record):
         layout += data_layout(self.data_width)
         Record.__init__(self, layout)
 
-def cmd_description(address_width):
-    return [
+def cmd_description(address_width, len_bits=0):
+    r = [
         ("we",   1),
         ("addr", address_width)
     ]
+    if len_bits:
+        r.append(("len", len_bits)) # len+1 consecutive words
+    return r
 
 
 def wdata_description(data_width):
@@ -103,12 +140,12 @@ def rdata_description(data_width):
 
 
 class LiteDRAMNativePort(Settings):
-    def __init__(self, mode, address_width, data_width, clock_domain="sys", id=0):
+    def __init__(self, mode, address_width, data_width, clock_domain="sys", id=0, len_bits=0):
         self.set_attributes(locals())
 
         self.lock = Signal()
 
-        self.cmd = stream.Endpoint(cmd_description(address_width))
+        self.cmd = stream.Endpoint(cmd_description(address_width, len_bits))
         self.wdata = stream.Endpoint(wdata_description(data_width))
         self.rdata = stream.Endpoint(rdata_description(data_width))
 
@@ -119,8 +156,12 @@ class LiteDRAMNativePort(Settings):
         self.dw = self.data_width
         self.cd = self.clock_domain
 
-    def get_bank_address(self, bank_bits, cba_shift):
+    def get_bank_address(self, bank_bits, cba_shift, xor_bits=0):
         cba_upper = cba_shift + bank_bits
+        if xor_bits:
+            # permutation-based interleaving: the low row bits (just above the bank
+            # bits) are XORed into the bank bits, row/column address is unchanged
+            return self.cmd.addr[cba_shift:cba_upper] ^ self.cmd.addr[cba_upper:cba_upper+xor_bits]
         return self.cmd.addr[cba_shift:cba_upper]
 
     def get_row_column_address(self, bank_bits, rca_bits, cba_shift):
@@ -162,6 +203,20 @@ def cmd_request_rw_layout(a, ba):
     ]
 
 
+def get_runtime_setting(settings, name, default):
+    """Controller setting tunable at runtime (CSRStorage) when the controller is
+    built with runtime CSRs, elaboration value otherwise."""
+    return getattr(settings, "runtime", {}).get(name, default)
+
+
+def get_cmd_queue_depth(settings):
+    """Maximum number of commands queued in a bank machine before its command
+    buffer (a queue of a shared command pool can hold the whole pool)."""
+    if getattr(settings, "cmd_pool_depth", 0):
+        return settings.cmd_pool_depth + 1
+    return settings.cmd_buffer_depth
+
+
 class tXXDController(Module):
     def __init__(self, txxd):
         self.valid = valid = Signal()
@@ -171,11 +226,14 @@ class tXXDController(Module):
         # # #
 
         if txxd is not None:
-            count = Signal(max=max(txxd, 2))
+            if isinstance(txxd, int):
+                count = Signal(max=max(txxd, 2))
+            else:
+                count = Signal(len(txxd)) # runtime value
             self.sync += \
                 If(valid,
                     count.eq(txxd-1),
-                    If((txxd - 1) == 0,
+                    If(txxd <= 1,
                         ready.eq(1)
                     ).Else(
                         ready.eq(0)
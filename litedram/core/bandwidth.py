@@ -6,11 +6,14 @@ from litex.soc.interconnect.csr import *
 
 
 class Bandwidth(Module, AutoCSR):
-    def __init__(self, cmd, data_width, period_bits=24):
+    def __init__(self, cmd, data_width, period_bits=24, refresher=None):
         self.update = CSR()
         self.nreads = CSRStatus(period_bits)
         self.nwrites = CSRStatus(period_bits)
         self.data_width = CSRStatus(bits_for(data_width), reset=data_width)
+        if refresher is not None:
+            self.nrefreshes_early = CSRStatus(period_bits)
+            self.nrefreshes_forced = CSRStatus(period_bits)
 
         # # #
 
@@ -47,3 +50,22 @@ class Bandwidth(Module, AutoCSR):
                 self.nwrites.status.eq(nwrites_r)
             )
         ]
+
+        # refreshes started early (opportunistically) vs forced
+        if refresher is not None:
+            for name in ["early", "forced"]:
+                event = getattr(refresher, name)
+                csr = getattr(self, "nrefreshes_" + name)
+                count = Signal(period_bits)
+                count_r = Signal(period_bits)
+                self.sync += [
+                    If(period,
+                        count_r.eq(count),
+                        count.eq(0)
+                    ).Elif(event,
+                        count.eq(count + 1)
+                    ),
+                    If(self.update.re,
+                        csr.status.eq(count_r)
+                    )
+                ]
@@ -3,6 +3,7 @@
 import math
 
 from migen import *
+from migen.genlib.roundrobin import *
 
 from litex.soc.interconnect import stream
 
@@ -24,8 +25,357 @@ class _AddressSlicer:
         return Cat(Replicate(0, self.address_align), address[:split])
 
 
+class _FRFCFSQueue(Module):
+    """First-Ready First-Come-First-Served command queue.
+
+    Commands are kept oldest first in a collapsing register queue. The command
+    presented on source is the oldest one hitting the opened row that is also
+    the oldest command of its type (read or write) and does not bypass an older
+    command to the same address: read and write data ordering is then preserved
+    for the crossbar. Reads (writes) held by the crossbar (not the oldest ones
+    of the master) can't bypass older commands, which could otherwise deadlock
+    against the crossbar cross-bank ordering. When no command qualifies, or when
+    the oldest command has already been bypassed max_age times, the oldest
+    command is presented.
+    """
+    def __init__(self, layout, depth, max_age, row_of):
+        self.sink = sink = stream.Endpoint(layout)
+        self.source = source = stream.Endpoint(layout)
+        self.row = Signal(len(row_of(sink.addr)))
+        self.row_opened = Signal()
+        self.read_hold = Signal()
+        self.write_hold = Signal()
+
+        # # #
+
+        valids = [Signal() for i in range(depth)]
+        wes = [Signal() for i in range(depth)]
+        addrs = [Signal(len(sink.addr)) for i in range(depth)]
+
+        level = Signal(max=depth+1)
+        sel = Signal(max=max(depth, 2))
+        push = Signal()
+        pop = Signal()
+        self.comb += [
+            sink.ready.eq(~valids[depth-1]),
+            push.eq(sink.valid & sink.ready),
+            pop.eq(source.valid & source.ready)
+        ]
+        self.sync += If(push & ~pop,
+                level.eq(level + 1)
+            ).Elif(pop & ~push,
+                level.eq(level - 1)
+            )
+
+        # Collapsing queue: entries above the popped one shift down, pushed
+        # command is written to the first free entry
+        for i in range(depth):
+            if i + 1 < depth:
+                shifted = [valids[i].eq(valids[i+1]), wes[i].eq(wes[i+1]), addrs[i].eq(addrs[i+1])]
+            else:
+                shifted = [valids[i].eq(0)]
+            self.sync += \
+                If(push & ((level - pop) == i),
+                    valids[i].eq(1),
+                    wes[i].eq(sink.we),
+                    addrs[i].eq(sink.addr)
+                ).Elif(pop & (sel <= i),
+                    *shifted
+                )
+
+        # Bypass counter of the oldest command
+        age = Signal(max=max_age+1)
+        max_age_reached = Signal()
+        self.comb += max_age_reached.eq(age == max_age)
+        self.sync += \
+            If(pop,
+                If(sel == 0,
+                    age.eq(0)
+                ).Else(
+                    age.eq(age + 1)
+                )
+            )
+
+        # Selection
+        for i in reversed(range(depth)):
+            eligible = valids[i] & self.row_opened & (row_of(addrs[i]) == self.row)
+            eligible = eligible & ~Mux(wes[i], self.write_hold, self.read_hold)
+            for j in range(i):
+                eligible = eligible & (~valids[j] | ((wes[j] != wes[i]) & (addrs[j] != addrs[i])))
+            self.comb += If(eligible & ~max_age_reached, sel.eq(i))
+
+        self.comb += [
+            source.valid.eq(valids[0]),
+            source.we.eq(Array(wes)[sel]),
+            source.addr.eq(Array(addrs)[sel])
+        ]
+
+
+class _RowHitPredictor(Module):
+    """Saturating counter predicting if the opened row should be closed.
+
+    Trained towards closing when a row conflict forces a precharge and towards
+    keeping the row opened when the opened row is hit again or when an
+    activate re-opens the row that has just been auto-precharged.
+    """
+    def __init__(self, nbits=2):
+        self.hit = Signal()
+        self.miss = Signal()
+        self.close = Signal()
+
+        # # #
+
+        counter = Signal(nbits, reset=2**(nbits-1))
+        self.sync += \
+            If(self.miss,
+                If(counter != (2**nbits - 1),
+                    counter.eq(counter + 1)
+                )
+            ).Elif(self.hit,
+                If(counter != 0,
+                    counter.eq(counter - 1)
+                )
+            )
+        self.comb += self.close.eq(counter[-1])
+
+
+class _CommandPoolQueue:
+    def __init__(self, layout):
+        self.sink = stream.Endpoint(layout)
+        self.source = stream.Endpoint(layout)
+        self.nonempty = Signal()
+
+
+class CommandPool(Module):
+    """Command queues of the bank machines sharing a pool of entries.
+
+    Each queue keeps its oldest command in a register (presented on its source
+    as the head of a FIFO), the following ones are linked lists of entries of a
+    memory of depth entries shared by all the queues: a queue can hold up to
+    depth+1 commands while the total storage stays bounded. One command is
+    accepted per cycle (queues served in round-robin) and one head register is
+    refilled from the memory per cycle.
+    """
+    def __init__(self, layout, nqueues, depth):
+        self.queues = queues = [_CommandPoolQueue(layout) for i in range(nqueues)]
+
+        # # #
+
+        ptr_bits = log2_int(depth, False)
+        def payload(endpoint):
+            return Cat(*[getattr(endpoint, name) for name, _ in layout])
+        width = len(payload(queues[0].sink))
+
+        data = Memory(width, depth)
+        nexts = Memory(ptr_bits, depth)
+        data_wrport = data.get_port(write_capable=True)
+        data_rdport = data.get_port(async_read=True)
+        nexts_wrport = nexts.get_port(write_capable=True)
+        nexts_rdport = nexts.get_port(async_read=True)
+        self.specials += data, nexts, data_wrport, data_rdport, nexts_wrport, nexts_rdport
+
+        # Free entries: never used ones (in order) then released ones
+        fresh = Signal(max=depth+1)
+        free = stream.SyncFIFO([("ptr", ptr_bits)], depth)
+        self.submodules += free
+        alloc = Signal()
+        alloc_ptr = Signal(ptr_bits)
+        alloc_ready = Signal()
+        self.comb += [
+            alloc_ready.eq((fresh != depth) | free.source.valid),
+            If(fresh != depth,
+                alloc_ptr.eq(fresh)
+            ).Else(
+                alloc_ptr.eq(free.source.ptr),
+                free.source.ready.eq(alloc)
+            )
+        ]
+        self.sync += If(alloc & (fresh != depth), fresh.eq(fresh + 1))
+
+        # Arbitration of the pushes and of the head refills
+        push_arbiter = RoundRobin(nqueues, SP_CE)
+        refill_arbiter = RoundRobin(nqueues, SP_CE)
+        self.submodules += push_arbiter, refill_arbiter
+        self.comb += [
+            push_arbiter.request.eq(Cat(*[q.sink.valid for q in queues])),
+            push_arbiter.ce.eq(1),
+            refill_arbiter.ce.eq(1)
+        ]
+
+        heads = [Signal(ptr_bits) for i in range(nqueues)]
+        tails = [Signal(ptr_bits) for i in range(nqueues)]
+        counts = [Signal(max=depth+1) for i in range(nqueues)]
+        refill_ptr = Signal(ptr_bits)
+        self.comb += [
+            refill_ptr.eq(Array(heads)[refill_arbiter.grant]),
+            data_rdport.adr.eq(refill_ptr),
+            nexts_rdport.adr.eq(refill_ptr),
+            data_wrport.adr.eq(alloc_ptr),
+            data_wrport.dat_w.eq(Array(payload(q.sink) for q in queues)[push_arbiter.grant]),
+            nexts_wrport.adr.eq(Array(tails)[push_arbiter.grant]),
+            nexts_wrport.dat_w.eq(alloc_ptr)
+        ]
+
+        refill_needs = []
+        for i, (q, head, tail, count) in enumerate(zip(queues, heads, tails, counts)):
+            head_valid = Signal()
+            head_free = Signal()  # head register empty or popped
+            refill = Signal()
+            direct = Signal()     # pushed command goes to the head register
+            push = Signal()
+            linked = Signal()     # pushed command goes to the memory
+            refill_need = Signal()
+            refill_needs.append(refill_need)
+            self.comb += [
+                q.source.valid.eq(head_valid),
+                q.nonempty.eq(head_valid | (count != 0)),
+                head_free.eq(~head_valid | q.source.ready),
+                refill_need.eq(head_free & (count != 0)),
+                refill.eq(refill_need & (refill_arbiter.grant == i)),
+                direct.eq(head_free & (count == 0)),
+                q.sink.ready.eq((push_arbiter.grant == i) & (direct | alloc_ready)),
+                push.eq(q.sink.valid & q.sink.ready),
+                linked.eq(push & ~direct),
+                If(linked,
+                    alloc.eq(1),
+                    data_wrport.we.eq(1),
+                    nexts_wrport.we.eq(count != 0)
+                ),
+                If(refill,
+                    free.sink.valid.eq(1),
+                    free.sink.ptr.eq(head)
+                )
+            ]
+            self.sync += [
+                If(push & direct,
+                    head_valid.eq(1),
+                    payload(q.source).eq(payload(q.sink))
+                ).Elif(refill,
+                    head_valid.eq(1),
+                    payload(q.source).eq(data_rdport.dat_r)
+                ).Elif(q.source.ready,
+                    head_valid.eq(0)
+                ),
+                If(linked,
+                    tail.eq(alloc_ptr),
+                    # new single entry list (possibly replacing the refilled one)
+                    If((count == 0) | ((count == 1) & refill),
+                        head.eq(alloc_ptr)
+                    ).Elif(refill,
+                        head.eq(nexts_rdport.dat_r)
+                    ),
+                    If(~refill, count.eq(count + 1))
+                ).Elif(refill,
+                    head.eq(nexts_rdport.dat_r),
+                    count.eq(count - 1)
+                )
+            ]
+        self.comb += refill_arbiter.request.eq(Cat(*refill_needs))
+
+
+class BankBinder(Module):
+    """Bank machines dynamically bound to the banks.
+
+    With fewer bank machines than banks, the requests of a bank are routed to
+    the bank machine bound to it. A bank with a pending request and no bank
+    machine is bound (one bank per cycle, banks served in round-robin) to an
+    idle bank machine: an unbound one first, else one bound to a bank with no
+    pending command, which is released. The open row of a released bank is kept
+    in a table (the bank is not precharged) and restored in the bank machine
+    the bank is bound to next; rows of the ranks being refreshed are cleared
+    from the table (precharge all). While a bank is waiting for a bank machine,
+    the bank machines that have accepted a command since their binding stop
+    accepting commands so that one of them drains.
+    """
+    def __init__(self, interface, bank_machines, refresher, settings):
+        banks = [getattr(interface, "bank"+str(i)) for i in range(interface.nbanks)]
+        nbanks = len(banks)
+        nmachines = len(bank_machines)
+        bankbits = settings.geom.bankbits
+
+        # # #
+
+        # Open rows of the banks with no bound bank machine
+        table_row = Array(Signal(settings.geom.rowbits) for i in range(nbanks))
+        table_opened = Array(Signal() for i in range(nbanks))
+        refreshing = [refresher.ranks[i >> bankbits] for i in range(nbanks)]
+        self.sync += [If(refreshing[i], table_opened[i].eq(0)) for i in range(nbanks)]
+
+        # Routing of the requests
+        bounds = [Signal() for i in range(nmachines)]
+        serveds = [Signal() for i in range(nmachines)]  # command accepted since the binding
+        stalls = [Signal() for i in range(nmachines)]
+        bank_bounds = [Signal() for i in range(nbanks)]
+        stall = Signal()
+        for bound, served, bm_stall, bm in zip(bounds, serveds, stalls, bank_machines):
+            self.comb += [
+                bm_stall.eq(stall & served),
+                bm.req.valid.eq(bound & ~bm_stall & Array(b.valid for b in banks)[bm.bank])
+            ]
+            self.sync += \
+                If(bm.bind,
+                    served.eq(0)
+                ).Elif(bm.req.valid & bm.req.ready,
+                    served.eq(1)
+                )
+            for name in ["we", "addr", "read_hold", "write_hold", "read_next_hold", "write_next_hold"]:
+                self.comb += getattr(bm.req, name).eq(Array(getattr(b, name) for b in banks)[bm.bank])
+        for i, (bank, bank_bound) in enumerate(zip(banks, bank_bounds)):
+            for bound, bm_stall, bm in zip(bounds, stalls, bank_machines):
+                selected = Signal()
+                self.comb += [
+                    selected.eq(bound & (bm.bank == i)),
+                    If(selected,
+                        bank_bound.eq(1),
+                        bank.ready.eq(bm.req.ready & ~bm_stall),
+                        bank.lock.eq(bm.req.lock),
+                        bank.wdata_ready.eq(bm.req.wdata_ready),
+                        bank.rdata_valid.eq(bm.req.rdata_valid)
+                    )
+                ]
+
+        # Binding
+        wants = Signal(nbanks)
+        self.comb += [wants[i].eq(bank.valid & ~bank_bound & ~refreshing[i])
+            for i, (bank, bank_bound) in enumerate(zip(banks, bank_bounds))]
+        self.comb += stall.eq(wants != 0)
+
+        machine = Signal(max=max(nmachines, 2))
+        machine_free = Signal()
+        # lowest idle bank machine, the unbound ones first
+        for unbound in [False, True]:
+            for i in reversed(range(nmachines)):
+                cond = bank_machines[i].idle & (~bounds[i] if unbound else bounds[i])
+                self.comb += If(cond, machine.eq(i), machine_free.eq(1))
+
+        bind = Signal()
+        want = Signal()
+        self.submodules.arbiter = arbiter = RoundRobin(nbanks, SP_CE)
+        self.comb += [
+            arbiter.request.eq(wants),
+            want.eq((wants >> arbiter.grant)[0]),
+            bind.eq(want & machine_free),
+            arbiter.ce.eq(~want | bind)
+        ]
+        for i, (bound, bm) in enumerate(zip(bounds, bank_machines)):
+            self.comb += [
+                bm.bind.eq(bind & (machine == i)),
+                bm.bind_bank.eq(arbiter.grant),
+                bm.bind_row.eq(table_row[arbiter.grant]),
+                bm.bind_row_opened.eq(table_opened[arbiter.grant])
+            ]
+            self.sync += \
+                If(bm.bind,
+                    bound.eq(1),
+                    If(bound,
+                        table_row[bm.bank].eq(bm.row),
+                        table_opened[bm.bank].eq(bm.row_opened)
+                    )
+                )
+
+
 class BankMachine(Module):
-    def __init__(self, n, aw, address_align, nranks, settings):
+    def __init__(self, n, aw, address_align, nranks, settings, cmd_queue=None, virtual=False):
         self.req = req = Record(cmd_layout(aw))
         self.refresh_req = refresh_req = Signal()
         self.refresh_gnt = refresh_gnt = Signal()
@@ -34,25 +384,67 @@ class BankMachine(Module):
         ba = settings.geom.bankbits + log2_int(nranks)
         self.cmd = cmd = stream.Endpoint(cmd_request_rw_layout(a, ba))
 
+        if virtual:
+            # bank bound by a BankBinder (with its open row), released when idle
+            self.bank = Signal(ba)
+            self.bind = Signal()
+            self.bind_bank = Signal(ba)
+            self.bind_row = Signal(settings.geom.rowbits)
+            self.bind_row_opened = Signal()
+            self.row = Signal(settings.geom.rowbits)
+            self.row_opened = Signal()
+            self.idle = Signal()
+
         # # #
 
         auto_precharge = Signal()
 
+        slicer = _AddressSlicer(settings.geom.colbits, address_align)
+
         # Command buffer
         cmd_buffer_layout = [("we", 1), ("addr", len(req.addr))]
-        cmd_buffer_lookahead = stream.SyncFIFO(
-            cmd_buffer_layout, settings.cmd_buffer_depth,
-            buffered=settings.cmd_buffer_buffered)
+        if cmd_queue is not None:
+            # queue of a shared CommandPool
+            cmd_buffer_lookahead = cmd_queue
+        elif settings.with_frfcfs:
+            cmd_buffer_lookahead = _FRFCFSQueue(
+                cmd_buffer_layout, settings.cmd_buffer_depth,
+                settings.frfcfs_max_age, slicer.row)
+        else:
+            cmd_buffer_lookahead = stream.SyncFIFO(
+                cmd_buffer_layout, settings.cmd_buffer_depth,
+                buffered=settings.cmd_buffer_buffered)
         cmd_buffer = stream.Buffer(cmd_buffer_layout) # 1 depth buffer to detect row change
-        self.submodules += cmd_buffer_lookahead, cmd_buffer
+        self.submodules += cmd_buffer
+        if cmd_queue is None:
+            self.submodules += cmd_buffer_lookahead
+            lookahead_nonempty = cmd_buffer_lookahead.source.valid
+        else:
+            lookahead_nonempty = cmd_queue.nonempty
         self.comb += [
             req.connect(cmd_buffer_lookahead.sink, keep={"valid", "ready", "we", "addr"}),
             cmd_buffer_lookahead.source.connect(cmd_buffer.sink),
             cmd_buffer.source.ready.eq(req.wdata_ready | req.rdata_valid),
-            req.lock.eq(cmd_buffer_lookahead.source.valid | cmd_buffer.source.valid),
+            req.lock.eq(lookahead_nonempty | cmd_buffer.source.valid),
         ]
 
-        slicer = _AddressSlicer(settings.geom.colbits, address_align)
+        # Pending writes and next command type (for the multiplexer write watermarks)
+        self.nwrites = Signal(max=get_cmd_queue_depth(settings)+3)
+        self.read_next = Signal()
+        self.write_next = Signal()
+        if settings.write_high_watermark:
+            count_in = Signal()
+            count_out = Signal()
+            self.comb += [
+                count_in.eq(req.valid & req.ready & req.we),
+                count_out.eq(cmd_buffer.source.valid & cmd_buffer.source.ready & cmd_buffer.source.we)
+            ]
+            self.sync += \
+                If(count_in & ~count_out,
+                    self.nwrites.eq(self.nwrites + 1)
+                ).Elif(count_out & ~count_in,
+                    self.nwrites.eq(self.nwrites - 1)
+                )
 
         # Row tracking
         row = Signal(settings.geom.rowbits)
@@ -68,11 +460,33 @@ class BankMachine(Module):
                 row_opened.eq(1),
                 row.eq(slicer.row(cmd_buffer.source.addr))
             )
+        if virtual:
+            self.sync += \
+                If(self.bind,
+                    self.bank.eq(self.bind_bank),
+                    row_opened.eq(self.bind_row_opened),
+                    row.eq(self.bind_row)
+                )
+            self.comb += [
+                self.row.eq(row),
+                self.row_opened.eq(row_opened)
+            ]
+        if settings.with_frfcfs:
+            self.comb += [
+                cmd_buffer_lookahead.row.eq(row),
+                cmd_buffer_lookahead.row_opened.eq(row_opened),
+                # when the oldest read (write) of the master is the one in cmd_buffer,
+                # the next one has to be in this bank
+                cmd_buffer_lookahead.read_hold.eq(req.read_hold |
+                    (cmd_buffer.source.valid & ~cmd_buffer.source.we & req.read_next_hold)),
+                cmd_buffer_lookahead.write_hold.eq(req.write_hold |
+                    (cmd_buffer.source.valid & cmd_buffer.source.we & req.write_next_hold))
+            ]
 
         # Address generation
         row_col_n_addr_sel = Signal()
         self.comb += [
-            cmd.ba.eq(n),
+            cmd.ba.eq(self.bank if virtual else n),
             If(row_col_n_addr_sel,
                 cmd.a.eq(slicer.row(cmd_buffer.source.addr))
             ).Else(
@@ -82,28 +496,115 @@ class BankMachine(Module):
 
         # tWTP (write-to-precharge) controller
         write_latency = math.ceil(settings.phy.cwl / settings.phy.nphases)
-        precharge_time = write_latency + settings.timing.tWR + settings.timing.tCCD # AL=0
+        precharge_time = (write_latency + # AL=0
+            get_runtime_setting(settings, "tWR", settings.timing.tWR) +
+            get_runtime_setting(settings, "tCCD", settings.timing.tCCD))
         self.submodules.twtpcon = twtpcon = tXXDController(precharge_time)
         self.comb += twtpcon.valid.eq(cmd.valid & cmd.ready & cmd.is_write)
 
         # tRC (activate-activate) controller
-        self.submodules.trccon = trccon = tXXDController(settings.timing.tRC)
+        self.submodules.trccon = trccon = tXXDController(
+            get_runtime_setting(settings, "tRC", settings.timing.tRC))
         self.comb += trccon.valid.eq(cmd.valid & cmd.ready & row_open)
 
         # tRAS (activate-precharge) controller
-        self.submodules.trascon = trascon = tXXDController(settings.timing.tRAS)
+        self.submodules.trascon = trascon = tXXDController(
+            get_runtime_setting(settings, "tRAS", settings.timing.tRAS))
         self.comb += trascon.valid.eq(cmd.valid & cmd.ready & row_open)
 
+        # Row hit/miss/conflict events (for the performance monitor)
+        self.row_hit = Signal()
+        self.row_miss = Signal()
+        self.row_conflict = Signal()
+        cas_done = Signal()
+        act_done = Signal()
+        pre_done = Signal()
+        activated = Signal()    # ACT done for the pending command
+        conflicted = Signal()   # PRE done for the pending command
+        self.comb += [
+            cas_done.eq(cmd.valid & cmd.ready & cmd.cas),
+            act_done.eq(cmd.valid & cmd.ready & row_open),
+            pre_done.eq(cmd.valid & cmd.ready & cmd.ras & ~cmd.cas & cmd.we),
+            self.row_hit.eq(cas_done & ~activated),
+            self.row_miss.eq(act_done & ~conflicted),
+            self.row_conflict.eq(pre_done),
+        ]
+        self.sync += [
+            If(act_done,
+                activated.eq(1),
+                conflicted.eq(0)
+            ).Elif(cas_done,
+                activated.eq(0)
+            ),
+            If(pre_done,
+                conflicted.eq(1)
+            )
+        ]
+
         # Auto Precharge generation
-        if settings.with_auto_precharge:
+        next_row_differs = Signal()
+        self.comb += next_row_differs.eq(
+            slicer.row(cmd_buffer_lookahead.source.addr) != slicer.row(cmd_buffer.source.addr))
+        with_auto_precharge = get_runtime_setting(settings,
+            "with_auto_precharge", settings.with_auto_precharge)
+        if settings.page_policy == "open":
+            if with_auto_precharge is not False:
+                self.comb += \
+                    If(with_auto_precharge & cmd_buffer_lookahead.source.valid & cmd_buffer.source.valid,
+                        If(next_row_differs,
+                            auto_precharge.eq(row_close == 0)
+                        )
+                    )
+        elif settings.page_policy == "close":
+            self.comb += \
+                If(cmd_buffer.source.valid,
+                    If(~cmd_buffer_lookahead.source.valid | next_row_differs,
+                        auto_precharge.eq(row_close == 0)
+                    )
+                )
+        elif settings.page_policy == "adaptive":
+            self.submodules.predictor = predictor = _RowHitPredictor()
             self.comb += \
-                If(cmd_buffer_lookahead.source.valid & cmd_buffer.source.valid,
-                    If(slicer.row(cmd_buffer_lookahead.source.addr) !=
-                       slicer.row(cmd_buffer.source.addr),
+                If(cmd_buffer.source.valid,
+                    If(cmd_buffer_lookahead.source.valid,
+                        If(next_row_differs,
+                            auto_precharge.eq(row_close == 0)
+                        )
+                    ).Elif(predictor.close,
                         auto_precharge.eq(row_close == 0)
                     )
                 )
 
+            # Training
+            row_accessed = Signal()     # CAS already done on the opened row
+            row_autoclosed = Signal()   # last row closed by auto-precharge
+            self.sync += [
+                If(act_done,
+                    row_accessed.eq(0),
+                    row_autoclosed.eq(0)
+                ).Elif(cas_done,
+                    row_accessed.eq(1),
+                    row_autoclosed.eq(auto_precharge)
+                )
+            ]
+            self.comb += [
+                predictor.hit.eq(
+                    (cas_done & row_accessed) |
+                    (act_done & row_autoclosed & (row == slicer.row(cmd_buffer.source.addr)))),
+                predictor.miss.eq(pre_done)
+            ]
+        else:
+            raise ValueError("Unsupported page policy: {}".format(settings.page_policy))
+
+        # Column commands held by the crossbar (read/write data ordering of the masters)
+        cas_hold = Signal()
+        self.comb += cas_hold.eq(Mux(cmd_buffer.source.we, req.write_hold, req.read_hold))
+        if settings.write_high_watermark:
+            self.comb += [
+                self.read_next.eq(cmd_buffer.source.valid & ~cmd_buffer.source.we & ~cas_hold),
+                self.write_next.eq(cmd_buffer.source.valid & cmd_buffer.source.we & ~cas_hold)
+            ]
+
         # Control and command generation FSM
         # Note: tRRD, tFAW, tCCD, tWTR timings are enforced by the multiplexer
         self.submodules.fsm = fsm = FSM()
@@ -113,7 +614,7 @@ class BankMachine(Module):
             ).Elif(cmd_buffer.source.valid,
                 If(row_opened,
                     If(row_hit,
-                        cmd.valid.eq(1),
+                        cmd.valid.eq(~cas_hold),
                         If(cmd_buffer.source.we,
                             req.wdata_ready.eq(cmd.ready),
                             cmd.is_write.eq(1),
@@ -154,7 +655,11 @@ class BankMachine(Module):
             row_close.eq(1)
         )
         fsm.act("ACTIVATE",
-            If(trccon.ready,
+            # Nothing to activate when the row has been closed by the page policy
+            # with no pending command
+            If(~cmd_buffer.source.valid,
+                NextState("REGULAR")
+            ).Elif(trccon.ready,
                 row_col_n_addr_sel.eq(1),
                 row_open.eq(1),
                 cmd.valid.eq(1),
@@ -175,5 +680,18 @@ class BankMachine(Module):
                 NextState("REGULAR")
             )
         )
-        fsm.delayed_enter("TRP", "ACTIVATE", settings.timing.tRP - 1)
-        fsm.delayed_enter("TRCD", "REGULAR", settings.timing.tRCD - 1)
+        for name, target, t in [("TRP", "ACTIVATE", "tRP"), ("TRCD", "REGULAR", "tRCD")]:
+            delay = get_runtime_setting(settings, t, getattr(settings.timing, t)) - 1
+            if isinstance(delay, int):
+                fsm.delayed_enter(name, target, delay)
+            else:
+                # runtime delay (at least one cycle)
+                count = Signal(len(delay))
+                self.sync += If(fsm.ongoing(name), count.eq(count + 1)).Else(count.eq(0))
+                fsm.act(name, If(count + 1 >= delay, NextState(target)))
+
+        if virtual:
+            # no pending command and the row can be precharged (by another bank machine
+            # or by the refresher) at any time
+            self.comb += self.idle.eq(fsm.ongoing("REGULAR") & ~refresh_req &
+                ~req.valid & ~req.lock & twtpcon.ready & trascon.ready)
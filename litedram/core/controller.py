@@ -2,6 +2,8 @@
 
 from migen import *
 
+from litex.soc.interconnect.csr import *
+
 from litedram.common import *
 from litedram.phy import dfi
 from litedram.core.refresher import *
@@ -11,12 +13,25 @@ from litedram.core.multiplexer import *
 
 class ControllerSettings(Settings):
     def __init__(self,
-                 cmd_buffer_depth=8, cmd_buffer_buffered=False,
+                 cmd_buffer_depth=8, cmd_buffer_buffered=False, cmd_pool_depth=0,
+                 nbank_machines=0,
+                 with_frfcfs=False, frfcfs_max_age=8,
                  read_time=32, write_time=16,
+                 write_high_watermark=0, write_low_watermark=0,
+                 with_multi_cmd=False,
+                 with_incremental_tfaw=False,
+                 with_registered_steerer=False,
                  with_bandwidth=False,
+                 with_perfmon=False,
                  with_refresh=True,
+                 refresh_postponing=0,
+                 refresh_mode="all",
+                 refresh_window=0,
+                 refresh_idle_threshold=4,
                  with_auto_precharge=True,
-                 address_mapping="ROW_BANK_COL"):
+                 page_policy="open",
+                 address_mapping="ROW_BANK_COL",
+                 with_runtime_csrs=False):
         self.set_attributes(locals())
 
 
@@ -40,25 +55,65 @@ class LiteDRAMController(Module):
 
         # # #
 
+        # runtime settings: read/write times, auto-precharge and timings (in sys clk
+        # cycles) backed by CSRs (reset to the elaboration values)
+        self.settings.runtime = {}
+        self.runtime_csrs = []
+        if settings.with_runtime_csrs:
+            runtime_settings = [
+                ("read_time", settings.read_time, bits_for(2*settings.read_time)),
+                ("write_time", settings.write_time, bits_for(2*settings.write_time)),
+                ("with_auto_precharge", int(settings.with_auto_precharge), 1)]
+            for name in ["tRP", "tRCD", "tWR", "tWTR", "tRRD", "tRC", "tRAS", "tCCD"]:
+                t = getattr(timing_settings, name)
+                if t is not None:
+                    runtime_settings.append((name, t, bits_for(2*t)))
+            for name, value, nbits in runtime_settings:
+                csr = CSRStorage(nbits, reset=value, name=name.lower())
+                setattr(self, name.lower(), csr)
+                self.runtime_csrs.append(csr)
+                self.settings.runtime[name] = csr.storage
+
         # refresher
-        refresher = Refresher(settings)
-        self.submodules += refresher
+        self.submodules.refresher = refresher = Refresher(settings)
+
+        # bank machines: one per bank or fewer (dynamically bound to the banks)
+        nbanks = phy_settings.nranks*(2**geom_settings.bankbits)
+        nbank_machines = settings.nbank_machines or nbanks
+        if nbank_machines > nbanks:
+            raise ValueError("More bank machines than banks: {} > {}".format(nbank_machines, nbanks))
+        virtual = nbank_machines < nbanks
+
+        # command queues of the bank machines shared in a pool
+        cmd_queues = [None]*nbank_machines
+        if settings.cmd_pool_depth:
+            if settings.with_frfcfs:
+                raise ValueError("FR-FCFS is not supported with a command pool")
+            self.submodules.cmd_pool = CommandPool(
+                [("we", 1), ("addr", interface.address_width)],
+                nbank_machines, settings.cmd_pool_depth)
+            cmd_queues = self.cmd_pool.queues
 
         # bank machines
         bank_machines = []
-        for i in range(phy_settings.nranks*(2**geom_settings.bankbits)):
+        for i in range(nbank_machines):
             bank_machine = BankMachine(i,
                 interface.address_width,
                 address_align,
                 phy_settings.nranks,
-                settings)
+                settings,
+                cmd_queues[i],
+                virtual)
             bank_machines.append(bank_machine)
             self.submodules += bank_machine
-            self.comb += getattr(interface, "bank"+str(i)).connect(bank_machine.req)
+            if not virtual:
+                self.comb += getattr(interface, "bank"+str(i)).connect(bank_machine.req)
+        if virtual:
+            self.submodules.binder = BankBinder(interface, bank_machines, refresher, settings)
 
         # multiplexer
         self.submodules.multiplexer = Multiplexer(
             settings, bank_machines, refresher, self.dfi, interface)
 
     def get_csrs(self):
-        return self.multiplexer.get_csrs()
+        return self.multiplexer.get_csrs() + self.runtime_csrs
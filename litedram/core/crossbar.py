@@ -7,29 +7,290 @@ from migen import *
 from migen.genlib import roundrobin
 
 from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import AutoCSR
 
 from litedram.common import *
 from litedram.core.controller import *
+from litedram.core.perfmon import PerformanceMonitor
 from litedram.frontend.adaptation import *
 
 
-class LiteDRAMCrossbar(Module):
+class _ReadReorderBuffer(Module):
+    """Read reorder buffer of a port.
+
+    A slot (tag) is allocated to each read command in issue order. Read data
+    returned by the controller (possibly out of order) is written to the slot
+    of its tag and presented on source in issue order.
+    """
+    def __init__(self, data_width, depth):
+        self.alloc = Signal()
+        self.alloc_ready = Signal()
+        self.alloc_tag = Signal(max=max(depth, 2))
+        self.write = Signal()
+        self.write_tag = Signal(max=max(depth, 2))
+        self.write_data = Signal(data_width)
+        self.source = source = stream.Endpoint(rdata_description(data_width))
+
+        # # #
+
+        level = Signal(max=depth+1)
+        consume = Signal(max=max(depth, 2))
+        valids = [Signal() for i in range(depth)]
+        pop = Signal()
+        self.comb += [
+            self.alloc_ready.eq(level != depth),
+            pop.eq(source.valid & source.ready)
+        ]
+        self.sync += [
+            If(self.alloc,
+                If(self.alloc_tag == depth - 1,
+                    self.alloc_tag.eq(0)
+                ).Else(
+                    self.alloc_tag.eq(self.alloc_tag + 1)
+                )
+            ),
+            If(pop,
+                If(consume == depth - 1,
+                    consume.eq(0)
+                ).Else(
+                    consume.eq(consume + 1)
+                )
+            ),
+            If(self.alloc & ~pop,
+                level.eq(level + 1)
+            ).Elif(pop & ~self.alloc,
+                level.eq(level - 1)
+            )
+        ]
+        for i, valid in enumerate(valids):
+            self.sync += \
+                If(self.write & (self.write_tag == i),
+                    valid.eq(1)
+                ).Elif(pop & (consume == i),
+                    valid.eq(0)
+                )
+
+        mem = Memory(data_width, depth)
+        wrport = mem.get_port(write_capable=True)
+        rdport = mem.get_port(async_read=True)
+        self.specials += mem, wrport, rdport
+        self.comb += [
+            wrport.we.eq(self.write),
+            wrport.adr.eq(self.write_tag),
+            wrport.dat_w.eq(self.write_data),
+            rdport.adr.eq(consume),
+            source.valid.eq(Array(valids)[consume]),
+            source.data.eq(rdport.dat_r)
+        ]
+
+
+class _WriteDataBuffer(Module):
+    """Write data buffer of a port.
+
+    A slot (tag) is allocated to each write command in issue order and write
+    data is accepted on sink as soon as its slot is allocated. Slots are read
+    and freed when their write is issued (possibly out of order).
+
+    With address_width, the address of each slot is also kept: a write to the
+    address of the previous command (back-to-back writes) that is not issued
+    yet is merged into its slot (byte masks are combined), and a read hitting
+    the last write to its address can be served from the buffer once its data
+    is complete.
+    """
+    def __init__(self, data_width, depth, address_width=None):
+        self.alloc = Signal()
+        self.alloc_ready = Signal()
+        self.alloc_tag = Signal(max=max(depth, 2))
+        self.sink = sink = stream.Endpoint(wdata_description(data_width))
+        self.valids = valids = [Signal() for i in range(depth)]
+        self.issue = Signal()
+        self.issue_tag = Signal(max=max(depth, 2))
+        self.read = Signal()
+        self.read_tag = Signal(max=max(depth, 2))
+        self.read_data = Signal(data_width)
+        self.read_we = Signal(data_width//8)
+        if address_width is not None:
+            self.addr = Signal(address_width)
+            self.read_cmd = Signal()
+            self.merge = Signal()
+            self.merge_ready = Signal()
+            self.forward_ready = Signal()
+            self.forward_wait = Signal()
+            self.forward_data = Signal(data_width)
+
+        # # #
+
+        busys = [Signal() for i in range(depth)]
+        issueds = [Signal() for i in range(depth)]
+        masks = [Signal(data_width//8) for i in range(depth)]
+        npendings = [Signal(max=depth+1) for i in range(depth)]
+        merge = self.merge if address_width is not None else 0
+
+        # slots of the accepted writes waiting for their data (a merged write uses the
+        # slot allocated last)
+        fill = stream.SyncFIFO([("tag", len(self.alloc_tag))], depth)
+        self.submodules += fill
+        last_tag = Signal.like(self.alloc_tag)
+        push = Signal()
+        self.comb += [
+            If(self.alloc_tag == 0,
+                last_tag.eq(depth - 1)
+            ).Else(
+                last_tag.eq(self.alloc_tag - 1)
+            ),
+            self.alloc_ready.eq(~Array(busys)[self.alloc_tag] & fill.sink.ready),
+            fill.sink.valid.eq(self.alloc | merge),
+            fill.sink.tag.eq(Mux(merge, last_tag, self.alloc_tag)),
+            sink.ready.eq(fill.source.valid),
+            fill.source.ready.eq(sink.valid),
+            push.eq(sink.valid & sink.ready)
+        ]
+        self.sync += \
+            If(self.alloc,
+                If(self.alloc_tag == depth - 1,
+                    self.alloc_tag.eq(0)
+                ).Else(
+                    self.alloc_tag.eq(self.alloc_tag + 1)
+                )
+            )
+        for i, (busy, issued, mask, npending, valid) in enumerate(
+            zip(busys, issueds, masks, npendings, valids)):
+            accepted = (self.alloc | merge) & (fill.sink.tag == i)
+            pushed = push & (fill.source.tag == i)
+            self.comb += valid.eq(busy & (npending == 0))
+            self.sync += [
+                If(self.alloc & (self.alloc_tag == i),
+                    busy.eq(1),
+                    issued.eq(0),
+                    mask.eq(0)
+                ).Elif(self.read & (self.read_tag == i),
+                    busy.eq(0)
+                ),
+                If(self.issue & (self.issue_tag == i),
+                    issued.eq(1)
+                ),
+                If(pushed,
+                    mask.eq(mask | sink.we)
+                ),
+                If(accepted & ~pushed,
+                    npending.eq(npending + 1)
+                ).Elif(pushed & ~accepted,
+                    npending.eq(npending - 1)
+                )
+            ]
+
+        mem = Memory(data_width, depth)
+        wrport = mem.get_port(write_capable=True, we_granularity=8)
+        rdport = mem.get_port(async_read=True)
+        self.specials += mem, wrport, rdport
+        self.comb += [
+            wrport.we.eq(Replicate(push, len(sink.we)) & sink.we),
+            wrport.adr.eq(fill.source.tag),
+            wrport.dat_w.eq(sink.data),
+            rdport.adr.eq(self.read_tag),
+            self.read_data.eq(rdport.dat_r),
+            self.read_we.eq(Array(masks)[self.read_tag])
+        ]
+
+        if address_width is not None:
+            addrs = [Signal(address_width) for i in range(depth)]
+            lasts = [Signal() for i in range(depth)]
+
+            # back-to-back writes: merged in the slot allocated by the previous command
+            # if it is a write to the same address that is not issued yet
+            last_write = Signal()
+            self.comb += [
+                self.merge_ready.eq(last_write & (Array(addrs)[last_tag] == self.addr) &
+                    Array(busys)[last_tag] & ~Array(issueds)[last_tag] &
+                    ~(self.issue & (self.issue_tag == last_tag)) & fill.sink.ready)
+            ]
+            self.sync += \
+                If(self.alloc | self.merge,
+                    last_write.eq(1)
+                ).Elif(self.read_cmd,
+                    last_write.eq(0)
+                )
+
+            # address CAM: only the last write to an address (not superseded by a newer
+            # one) can forward its data, reads wait for it to be received
+            hits = Signal(depth)
+            hit_tag = Signal.like(self.alloc_tag)
+            for i, (busy, addr, last, mask, valid) in enumerate(zip(busys, addrs, lasts, masks, valids)):
+                self.sync += \
+                    If(self.alloc,
+                        If(self.alloc_tag == i,
+                            addr.eq(self.addr),
+                            last.eq(1)
+                        ).Elif(addr == self.addr,
+                            last.eq(0)
+                        )
+                    )
+                self.comb += [
+                    hits[i].eq(busy & last & (addr == self.addr)),
+                    If(hits[i], hit_tag.eq(i))
+                ]
+            fwdport = mem.get_port(async_read=True)
+            self.specials += fwdport
+            self.comb += [
+                fwdport.adr.eq(hit_tag),
+                self.forward_data.eq(fwdport.dat_r),
+                self.forward_ready.eq((hits != 0) & Array(valids)[hit_tag] &
+                    (Array(masks)[hit_tag] == 2**len(masks[0]) - 1)),
+                self.forward_wait.eq((hits != 0) & ~Array(valids)[hit_tag])
+            ]
+
+
+class LiteDRAMCrossbar(Module, AutoCSR):
     def __init__(self, controller, ):
         self.controller = controller
 
         self.rca_bits = controller.address_width
         self.nbanks = controller.nbanks
         self.nranks = controller.nranks
-        self.cmd_buffer_depth = controller.settings.cmd_buffer_depth
-        self.read_latency = controller.settings.phy.read_latency + 1
-        self.write_latency = controller.settings.phy.write_latency + 1
+        self.cmd_buffer_depth = get_cmd_queue_depth(controller.settings)
+        # + commands pipeline of the multiplexer
+        cmd_latency = 1 + int(controller.settings.with_registered_steerer)
+        self.read_latency = controller.settings.phy.read_latency + cmd_latency
+        self.write_latency = controller.settings.phy.write_latency + cmd_latency
 
         self.bank_bits = log2_int(self.nbanks, False)
         self.rank_bits = log2_int(self.nranks, False)
 
         self.masters = []
 
-    def get_port(self, mode="both", data_width=None, clock_domain="sys", reverse=False, **kwargs):
+    def get_port(self, mode="both", data_width=None, clock_domain="sys", reverse=False,
+                 priority=0, weight=None, bandwidth=None, reorder_depth=0, write_buffer_depth=0,
+                 write_forwarding=False, len_bits=0, **kwargs):
+        """Add a new port to the crossbar.
+
+        len_bits: width of the optional len field of the port's commands (0: none).
+        A command then requests len+1 consecutive words: it is expanded in single
+        word commands in the sys clock domain, in front of the crossbar (one command
+        crosses the clock domains per burst).
+
+        reorder_depth: number of slots of the port's read reorder buffer (0: none).
+        With a read reorder buffer, the reads of the port are issued in any order
+        in the banks and read data is reordered before being presented on the port
+        (the port can also apply backpressure on rdata). The port can have at most
+        reorder_depth reads in flight.
+
+        write_buffer_depth: number of slots of the port's write data buffer (0: none).
+        With a write data buffer, write data is accepted as soon as the write command
+        is queued (posted writes) and the writes of the port are issued in any order
+        in the banks once their data is buffered. The port can have at most
+        write_buffer_depth writes in flight.
+        write_forwarding: merge back-to-back writes to the same address in the write
+        data buffer and, with a read reorder buffer, serve reads hitting a buffered
+        write from the buffer (requires write_buffer_depth).
+
+        QoS:
+        priority: requests of higher priority ports are served first, a port releases
+        a bank as soon as a higher priority port waits for it.
+        weight: number of consecutive commands a port can issue to a bank before
+        releasing it to the other ports waiting for it (None: no limit).
+        bandwidth: (ncmds, period) token bucket limiting the port to ncmds commands
+        every period cycles (None: no limit).
+        """
         # retro-compatibility # FIXME: remove
         if "cd" in kwargs:
             print("[WARNING] Please update LiteDRAMCrossbar.get_port's \"cd\" parameter to \"clock_domain\"")
@@ -41,6 +302,11 @@ class LiteDRAMCrossbar(Module):
         if self.finalized:
             raise FinalizeError
 
+        if write_forwarding and not write_buffer_depth:
+            raise ValueError("Write forwarding requires a write data buffer")
+        if len_bits and data_width is not None and data_width != self.controller.data_width:
+            raise ValueError("Burst commands are not supported with data width conversion")
+
         if data_width is None:
             # use internal data_width when no width adaptation is requested
             data_width = self.controller.data_width
@@ -52,8 +318,26 @@ class LiteDRAMCrossbar(Module):
             data_width=self.controller.data_width,
             clock_domain="sys",
             id=len(self.masters))
+        port.priority = priority
+        port.weight = weight
+        port.bandwidth = bandwidth
+        port.reorder_depth = reorder_depth
+        port.write_buffer_depth = write_buffer_depth
+        port.write_forwarding = write_forwarding
         self.masters.append(port)
 
+        # burst commands expansion
+        if len_bits:
+            new_port = LiteDRAMNativePort(
+                mode=mode,
+                address_width=port.address_width,
+                data_width=port.data_width,
+                clock_domain="sys",
+                id=port.id,
+                len_bits=len_bits)
+            self.submodules += LiteDRAMNativePortBurstExpander(new_port, port)
+            port = new_port
+
         # clock domain crossing
         if clock_domain != "sys":
             new_port = LiteDRAMNativePort(
@@ -61,7 +345,8 @@ class LiteDRAMCrossbar(Module):
                 address_width=port.address_width,
                 data_width=port.data_width,
                 clock_domain=clock_domain,
-                id=port.id)
+                id=port.id,
+                len_bits=len_bits)
             self.submodules += LiteDRAMNativePortCDC(new_port, port)
             port = new_port
 
@@ -91,12 +376,19 @@ class LiteDRAMCrossbar(Module):
         cba_shifts = {
             "ROW_BANK_COL": controller.settings.geom.colbits -
                             controller.address_align,
+            "ROW_BANK_COL_XOR": controller.settings.geom.colbits -
+                            controller.address_align,
             "ROW_COL_BANK": controller.settings.geom.rowbits +
                             controller.settings.geom.colbits -
                              controller.address_align
         }
         cba_shift = cba_shifts[controller.settings.address_mapping]
-        m_ba = [m.get_bank_address(self.bank_bits, cba_shift)for m in self.masters]
+        # bank XOR hashing: spread power of two strides (same bank, different rows)
+        # over the banks of a rank
+        xor_bits = 0
+        if controller.settings.address_mapping == "ROW_BANK_COL_XOR":
+            xor_bits = controller.settings.geom.bankbits
+        m_ba = [m.get_bank_address(self.bank_bits, cba_shift, xor_bits) for m in self.masters]
         m_rca = [m.get_row_column_address(self.bank_bits, self.rca_bits, cba_shift) for m in self.masters]
 
         master_readys = [0]*nmasters
@@ -106,29 +398,228 @@ class LiteDRAMCrossbar(Module):
         arbiters = [roundrobin.RoundRobin(nmasters, roundrobin.SP_CE) for n in range(self.nbanks)]
         self.submodules += arbiters
 
+        # bandwidth limits (token buckets)
+        master_throttled = []
+        for master in self.masters:
+            throttled = Signal()
+            if master.bandwidth is not None:
+                ncmds, period = master.bandwidth
+                assert 0 < ncmds <= period
+                tokens = Signal(max=ncmds+1, reset=ncmds)
+                credit = Signal(max=period+ncmds)
+                refill = Signal()
+                consume = Signal()
+                self.comb += [
+                    refill.eq((credit + ncmds >= period) & (tokens != ncmds)),
+                    consume.eq(master.cmd.valid & master.cmd.ready),
+                    throttled.eq(tokens == 0)
+                ]
+                self.sync += [
+                    If(credit + ncmds >= period,
+                        credit.eq(credit + ncmds - period)
+                    ).Else(
+                        credit.eq(credit + ncmds)
+                    ),
+                    If(refill & ~consume,
+                        tokens.eq(tokens + 1)
+                    ).Elif(consume & ~refill,
+                        tokens.eq(tokens - 1)
+                    )
+                ]
+            master_throttled.append(throttled)
+
+        # in-flight ordering: banks of the outstanding reads/writes of each master,
+        # in issue order. A bank machine only issues the read (write) of a master
+        # when its bank is the oldest one of the master's outstanding reads (writes):
+        # a master can have commands in several banks (activates/precharges are
+        # done in parallel) while its rdata/wdata is still returned in order.
+        # The oldest bank of each queue is kept in a buffer so that the next one can
+        # also be checked: with FR-FCFS, a command only bypasses older ones when it
+        # is the next read/write of the master (see _FRFCFSQueue).
+        # Reads of masters with a read reorder buffer are not ordered: their data
+        # is returned out of order and reordered in the buffer. Writes of masters
+        # with a write data buffer are not ordered either: they are only held until
+        # their data is buffered.
+        order_depth = max(self.cmd_buffer_depth + 2, 2*self.nbanks)
+        read_orders = []
+        write_orders = []
+        master_order_readys = []
+        master_robs = []
+        master_wdbs = []
+        master_bypasses = []
+        master_forwards = []
+        rob_returnings = []
+        for nm, master in enumerate(self.masters):
+            orders = []
+            for we in [0, 1]:
+                if (not we and master.reorder_depth) or (we and master.write_buffer_depth):
+                    orders.append(None)
+                    continue
+                order = stream.SyncFIFO([("bank", max(self.bank_bits, 1))], order_depth)
+                order_head = stream.Buffer([("bank", max(self.bank_bits, 1))])
+                self.submodules += order, order_head
+                self.comb += [
+                    order.sink.valid.eq(master.cmd.valid & master.cmd.ready & (master.cmd.we == we)),
+                    order.sink.bank.eq(m_ba[nm]),
+                    order.source.connect(order_head.sink)
+                ]
+                orders.append((order, order_head))
+            rob = None
+            if master.reorder_depth:
+                rob = _ReadReorderBuffer(self.controller.data_width, master.reorder_depth)
+                self.submodules += rob
+                self.comb += rob.alloc.eq(master.cmd.valid & master.cmd.ready & ~master.cmd.we)
+                read_ready = rob.alloc_ready
+            else:
+                read_ready = orders[0][0].sink.ready
+            wdb = None
+            bypass = 0
+            forward = None
+            wait = 0
+            rob_returning = Signal()
+            if master.write_buffer_depth:
+                wdb = _WriteDataBuffer(self.controller.data_width, master.write_buffer_depth,
+                    len(master.cmd.addr) if master.write_forwarding else None)
+                self.submodules += wdb
+                merge = 0
+                if master.write_forwarding:
+                    # merged writes and forwarded reads are acknowledged here, without
+                    # going to the banks
+                    merge = wdb.merge
+                    if rob is not None:
+                        forward = Signal()
+                        self.comb += forward.eq(master.cmd.valid & ~master.cmd.we &
+                            wdb.forward_ready & rob.alloc_ready & ~rob_returning)
+                        wait = ~master.cmd.we & wdb.forward_wait
+                    bypass = merge if forward is None else merge | forward
+                    self.comb += [
+                        wdb.addr.eq(master.cmd.addr),
+                        wdb.read_cmd.eq(master.cmd.valid & master.cmd.ready & ~master.cmd.we),
+                        wdb.merge.eq(master.cmd.valid & master.cmd.we & wdb.merge_ready)
+                    ]
+                self.comb += wdb.alloc.eq(master.cmd.valid & master.cmd.ready & master.cmd.we & ~merge)
+                write_ready = wdb.alloc_ready
+            else:
+                write_ready = orders[1][0].sink.ready
+            read_orders.append(orders[0])
+            write_orders.append(orders[1])
+            master_order_readys.append(Mux(master.cmd.we, write_ready, read_ready))
+            master_robs.append(rob)
+            master_wdbs.append(wdb)
+            master_bypasses.append(bypass | wait)
+            master_forwards.append(forward)
+            rob_returnings.append(rob_returning)
+            master_readys[nm] = bypass
+
+        # read tags: reorder buffer slot of the reads queued in each bank machine (reads
+        # are issued in order in a bank machine)
+        robs = [rob for rob in master_robs if rob is not None]
+        read_tag = Signal(max=max([2] + [2**len(rob.alloc_tag) for rob in robs]))
+        if robs:
+            for nb in range(self.nbanks):
+                bank = getattr(controller, "bank"+str(nb))
+                tags = stream.SyncFIFO([("tag", len(read_tag))], self.cmd_buffer_depth + 2)
+                self.submodules += tags
+                self.comb += [
+                    tags.sink.valid.eq(bank.valid & bank.ready & ~bank.we),
+                    tags.sink.tag.eq(Array(0 if rob is None else rob.alloc_tag
+                        for rob in master_robs)[arbiters[nb].grant]),
+                    tags.source.ready.eq(bank.rdata_valid),
+                    If(bank.rdata_valid, read_tag.eq(tags.source.tag))
+                ]
+
+        # write tags: write data buffer slot of the writes queued in each bank machine
+        # (writes are issued in order in a bank machine). The oldest write of a bank is
+        # held until its data is buffered.
+        wdbs = [wdb for wdb in master_wdbs if wdb is not None]
+        write_tag = Signal(max=max([2] + [2**len(wdb.alloc_tag) for wdb in wdbs]))
+        write_data_holds = []
+        for nb in range(self.nbanks):
+            bank = getattr(controller, "bank"+str(nb))
+            data_holds = [None]*len(self.masters)
+            if wdbs:
+                tags = stream.SyncFIFO([("tag", len(write_tag))], self.cmd_buffer_depth + 2)
+                self.submodules += tags
+                self.comb += [
+                    tags.sink.valid.eq(bank.valid & bank.ready & bank.we),
+                    tags.sink.tag.eq(Array(0 if wdb is None else wdb.alloc_tag
+                        for wdb in master_wdbs)[arbiters[nb].grant]),
+                    tags.source.ready.eq(bank.wdata_ready),
+                    If(bank.wdata_ready, write_tag.eq(tags.source.tag))
+                ]
+                for nm, wdb in enumerate(master_wdbs):
+                    if wdb is not None:
+                        data_holds[nm] = ~tags.source.valid | ~Array(wdb.valids)[tags.source.tag]
+            write_data_holds.append(data_holds)
+
+        priorities = [master.priority for master in self.masters]
+        weights = [master.weight for master in self.masters]
+
         rbank = Signal(max=self.nbanks)
         wbank = Signal(max=self.nbanks)
         for nb, arbiter in enumerate(arbiters):
             bank = getattr(controller, "bank"+str(nb))
 
-            # for each master, determine if another bank locks it
-            master_locked = []
-            for nm, master in enumerate(self.masters):
-                locked = Signal()
-                for other_nb, other_arbiter in enumerate(arbiters):
-                    if other_nb != nb:
-                        other_bank = getattr(controller, "bank"+str(other_nb))
-                        locked = locked | (other_bank.lock & (other_arbiter.grant == nm))
-                master_locked.append(locked)
+            # for each master, determine if its ordering queues can accept the command
+            master_blocked = [~order_ready | bypass
+                for order_ready, bypass in zip(master_order_readys, master_bypasses)]
+
+            # hold the reads/writes that are not the oldest ones of the granted master
+            for orders, hold, next_hold in [
+                (read_orders, bank.read_hold, bank.read_next_hold),
+                (write_orders, bank.write_hold, bank.write_next_hold)]:
+                for _hold, head in [(hold, True), (next_hold, False)]:
+                    holds = []
+                    for nm, order in enumerate(orders):
+                        if order is None:
+                            data_hold = write_data_holds[nb][nm] if orders is write_orders else None
+                            holds.append(data_hold if head and data_hold is not None else 0)
+                        else:
+                            endpoint = order[1].source if head else order[0].source
+                            holds.append(~endpoint.valid | (endpoint.bank != nb))
+                    self.comb += _hold.eq(Array(holds)[arbiter.grant])
 
             # arbitrate
-            bank_selected = [(ba == nb) & ~locked for ba, locked in zip(m_ba, master_locked)]
+            bank_selected = [(ba == nb) & ~blocked & ~throttled
+                for ba, blocked, throttled in zip(m_ba, master_blocked, master_throttled)]
             bank_requested = [bs & master.cmd.valid for bs, master in zip(bank_selected, self.masters)]
+            # only the highest priority requests are arbitrated
+            bank_arbitrated = []
+            for nm, requested in enumerate(bank_requested):
+                higher = [bank_requested[i] for i in range(nmasters) if priorities[i] > priorities[nm]]
+                if higher:
+                    requested = requested & ~reduce(or_, higher)
+                bank_arbitrated.append(requested)
             self.comb += [
-                arbiter.request.eq(Cat(*bank_requested)),
+                arbiter.request.eq(Cat(*bank_arbitrated)),
                 arbiter.ce.eq(~bank.valid & ~bank.lock)
             ]
 
+            # release the bank (stop serving the granted master, the arbiter then
+            # grants the next master once the bank is unlocked) when a higher
+            # priority master is waiting or when the granted master has issued
+            # its weight of commands while others are waiting.
+            release = Signal()
+            release_cases = {}
+            for nm in range(nmasters):
+                others = [bank_requested[i] for i in range(nmasters)
+                    if i != nm and priorities[i] >= priorities[nm]]
+                higher = [bank_requested[i] for i in range(nmasters) if priorities[i] > priorities[nm]]
+                cond = 0
+                if higher:
+                    cond = reduce(or_, higher)
+                if weights[nm] is not None and others:
+                    count = Signal(max=weights[nm]+1)
+                    self.sync += \
+                        If(arbiter.ce,
+                            count.eq(0)
+                        ).Elif((arbiter.grant == nm) & bank.valid & bank.ready & (count != weights[nm]),
+                            count.eq(count + 1)
+                        )
+                    cond = cond | ((count == weights[nm]) & reduce(or_, others))
+                release_cases[nm] = release.eq(cond)
+            self.comb += Case(arbiter.grant, release_cases)
+
             # Get rdata source bank
             self.sync += If((arbiter.grant == nm) & bank.rdata_valid, rbank.eq(nb))
 
@@ -142,15 +633,29 @@ class LiteDRAMCrossbar(Module):
             self.comb += [
                 bank.addr.eq(Array(m_rca)[arbiter.grant]),
                 bank.we.eq(Array(self.masters)[arbiter.grant].cmd.we),
-                bank.valid.eq(Array(bank_requested)[arbiter.grant])
+                bank.valid.eq(Array(bank_requested)[arbiter.grant] & ~release)
             ]
-            master_readys = [master_ready | ((arbiter.grant == nm) & bank_selected[nm] & bank.ready)
+            master_readys = [master_ready | ((arbiter.grant == nm) & bank_selected[nm] & ~release & bank.ready)
                 for nm, master_ready in enumerate(master_readys)]
             master_wdata_readys = [master_wdata_ready | ((arbiter.grant == nm) & bank.wdata_ready)
                 for nm, master_wdata_ready in enumerate(master_wdata_readys)]
             master_rdata_valids = [master_rdata_valid | ((arbiter.grant == nm) & bank.rdata_valid)
                 for nm, master_rdata_valid in enumerate(master_rdata_valids)]
 
+        # pop the ordering queues on the reads/writes of the masters
+        for read_order, master_rdata_valid in zip(read_orders, master_rdata_valids):
+            if read_order is not None:
+                self.comb += read_order[1].source.ready.eq(master_rdata_valid)
+        for write_order, master_wdata_ready in zip(write_orders, master_wdata_readys):
+            if write_order is not None:
+                self.comb += write_order[1].source.ready.eq(master_wdata_ready)
+        for wdb, master_wdata_ready in zip(master_wdbs, master_wdata_readys):
+            if wdb is not None:
+                self.comb += [
+                    wdb.issue.eq(master_wdata_ready),
+                    wdb.issue_tag.eq(write_tag)
+                ]
+
         for nm, master_wdata_ready in enumerate(master_wdata_readys):
                 for i in range(self.write_latency):
                     new_master_wdata_ready = Signal()
@@ -165,20 +670,60 @@ class LiteDRAMCrossbar(Module):
                     master_rdata_valid = new_master_rdata_valid
                 master_rdata_valids[nm] = master_rdata_valid
 
+        for i in range(self.write_latency):
+            new_write_tag = Signal.like(write_tag)
+            self.sync += new_write_tag.eq(write_tag)
+            write_tag = new_write_tag
+
+        for i in range(self.read_latency):
+            new_read_tag = Signal.like(read_tag)
+            self.sync += new_read_tag.eq(read_tag)
+            read_tag = new_read_tag
+
         for master, master_ready in zip(self.masters, master_readys):
             self.comb += master.cmd.ready.eq(master_ready)
-        for master, master_wdata_ready in zip(self.masters, master_wdata_readys):
-            self.comb += master.wdata.ready.eq(master_wdata_ready)
-        for master, master_rdata_valid in zip(self.masters, master_rdata_valids):
-            self.comb += master.rdata.valid.eq(master_rdata_valid)
+        for master, master_wdata_ready, wdb in zip(self.masters, master_wdata_readys, master_wdbs):
+            if wdb is None:
+                self.comb += master.wdata.ready.eq(master_wdata_ready)
+            else:
+                self.comb += [
+                    master.wdata.connect(wdb.sink),
+                    wdb.read.eq(master_wdata_ready),
+                    wdb.read_tag.eq(write_tag)
+                ]
+        for master, master_rdata_valid, rob, rob_returning, forward, wdb in zip(self.masters,
+            master_rdata_valids, master_robs, rob_returnings, master_forwards, master_wdbs):
+            if rob is None:
+                self.comb += master.rdata.valid.eq(master_rdata_valid)
+            else:
+                self.comb += [
+                    rob_returning.eq(master_rdata_valid),
+                    rob.write.eq(master_rdata_valid),
+                    rob.write_tag.eq(read_tag),
+                    rob.write_data.eq(controller.rdata),
+                    rob.source.connect(master.rdata)
+                ]
+                # forwarded reads are written on free cycles
+                if forward is not None:
+                    self.comb += If(forward,
+                        rob.write.eq(1),
+                        rob.write_tag.eq(rob.alloc_tag),
+                        rob.write_data.eq(wdb.forward_data)
+                    )
 
         # route data writes
         wdata_cases = {}
-        for nm, master in enumerate(self.masters):
-            wdata_cases[2**nm] = [
-                controller.wdata.eq(master.wdata.data),
-                controller.wdata_we.eq(master.wdata.we)
-            ]
+        for nm, (master, wdb) in enumerate(zip(self.masters, master_wdbs)):
+            if wdb is None:
+                wdata_cases[2**nm] = [
+                    controller.wdata.eq(master.wdata.data),
+                    controller.wdata_we.eq(master.wdata.we)
+                ]
+            else:
+                wdata_cases[2**nm] = [
+                    controller.wdata.eq(wdb.read_data),
+                    controller.wdata_we.eq(wdb.read_we)
+                ]
         wdata_cases["default"] = [
             controller.wdata.eq(0),
             controller.wdata_we.eq(0)
@@ -186,5 +731,17 @@ class LiteDRAMCrossbar(Module):
         self.comb += Case(Cat(*master_wdata_readys), wdata_cases)
 
         # route data reads
-        for master in self.masters:
-            self.comb += master.rdata.data.eq(controller.rdata)
+        for master, rob in zip(self.masters, master_robs):
+            if rob is None:
+                self.comb += master.rdata.data.eq(controller.rdata)
+
+        # per port requests counters
+        if controller.settings.with_perfmon:
+            events = []
+            for nm, master in enumerate(self.masters):
+                accepted = master.cmd.valid & master.cmd.ready
+                events += [
+                    ("port{}_reads".format(nm),  accepted & ~master.cmd.we),
+                    ("port{}_writes".format(nm), accepted & master.cmd.we),
+                ]
+            self.submodules.perfmon = PerformanceMonitor(events)
@@ -13,10 +13,11 @@ from litex.soc.interconnect.csr import AutoCSR
 
 from litedram.common import *
 from litedram.core.bandwidth import Bandwidth
+from litedram.core.perfmon import PerformanceMonitor
 
 
 class _CommandChooser(Module):
-    def __init__(self, requests):
+    def __init__(self, requests, allowed=None):
         self.want_reads = Signal()
         self.want_writes = Signal()
         self.want_cmds = Signal()
@@ -38,7 +39,10 @@ class _CommandChooser(Module):
             command = request.is_cmd & self.want_cmds & (~is_act_cmd | self.want_activates)
             read = request.is_read == self.want_reads
             write = request.is_write == self.want_writes
-            self.comb += valids[i].eq(request.valid & (command | (read & write)))
+            valid = request.valid & (command | (read & write))
+            if allowed is not None:
+                valid = valid & allowed[i]
+            self.comb += valids[i].eq(valid)
 
 
         arbiter = RoundRobin(n, SP_CE)
@@ -86,7 +90,7 @@ class _CommandChooser(Module):
 (STEER_NOP, STEER_CMD, STEER_REQ, STEER_REFRESH) = range(4)
 
 class _Steerer(Module):
-    def __init__(self, commands, dfi):
+    def __init__(self, commands, dfi, refresh_all_ranks=True, registered=False):
         ncmd = len(commands)
         nph = len(dfi.phases)
         self.sel = [Signal(max=ncmd) for i in range(nph)]
@@ -99,7 +103,27 @@ class _Steerer(Module):
             else:
                 return cmd.valid & cmd.ready & getattr(cmd, attr)
 
-        for i, (phase, sel) in enumerate(zip(dfi.phases, self.sel)):
+        # commands fields (flags only asserted on accepted commands)
+        fields = []
+        for cmd in commands:
+            f = {"a": cmd.a, "ba": cmd.ba}
+            for attr in ["cas", "ras", "we", "is_read", "is_write"]:
+                f[attr] = valid_and(cmd, attr)
+            fields.append(f)
+        sels = self.sel
+
+        # registered inputs: the accepted commands are presented one cycle later,
+        # their spacing is unchanged
+        if registered:
+            for f in fields:
+                for k, v in f.items():
+                    if not isinstance(v, int):
+                        f[k] = Signal(len(v))
+                        self.sync += f[k].eq(v)
+            sels = [Signal.like(sel) for sel in self.sel]
+            self.sync += [sel_r.eq(sel) for sel_r, sel in zip(sels, self.sel)]
+
+        for i, (phase, sel) in enumerate(zip(dfi.phases, sels)):
             nranks = len(phase.cs_n)
             rankbits = log2_int(nranks)
             if hasattr(phase, "reset_n"):
@@ -111,25 +135,25 @@ class _Steerer(Module):
             if rankbits:
                 rank_decoder = Decoder(nranks)
                 self.submodules += rank_decoder
-                self.comb += rank_decoder.i.eq((Array(cmd.ba[-rankbits:] for cmd in commands)[sel]))
-                if i == 0: # Select all ranks on refresh.
+                self.comb += rank_decoder.i.eq((Array(f["ba"][-rankbits:] for f in fields)[sel]))
+                if i == 0 and refresh_all_ranks: # Select all ranks on refresh.
                     self.sync += If(sel == STEER_REFRESH, phase.cs_n.eq(0)).Else(phase.cs_n.eq(~rank_decoder.o))
                 else:
                     self.sync += phase.cs_n.eq(~rank_decoder.o)
-                self.sync += phase.bank.eq(Array(cmd.ba[:-rankbits] for cmd in commands)[sel])
+                self.sync += phase.bank.eq(Array(f["ba"][:-rankbits] for f in fields)[sel])
             else:
                 self.sync += phase.cs_n.eq(0)
-                self.sync += phase.bank.eq(Array(cmd.ba[:] for cmd in commands)[sel])
+                self.sync += phase.bank.eq(Array(f["ba"][:] for f in fields)[sel])
 
             self.sync += [
-                phase.address.eq(Array(cmd.a for cmd in commands)[sel]),
-                phase.cas_n.eq(~Array(valid_and(cmd, "cas") for cmd in commands)[sel]),
-                phase.ras_n.eq(~Array(valid_and(cmd, "ras") for cmd in commands)[sel]),
-                phase.we_n.eq(~Array(valid_and(cmd, "we") for cmd in commands)[sel])
+                phase.address.eq(Array(f["a"] for f in fields)[sel]),
+                phase.cas_n.eq(~Array(f["cas"] for f in fields)[sel]),
+                phase.ras_n.eq(~Array(f["ras"] for f in fields)[sel]),
+                phase.we_n.eq(~Array(f["we"] for f in fields)[sel])
             ]
 
-            rddata_ens = Array(valid_and(cmd, "is_read") for cmd in commands)
-            wrdata_ens = Array(valid_and(cmd, "is_write") for cmd in commands)
+            rddata_ens = Array(f["is_read"] for f in fields)
+            wrdata_ens = Array(f["is_write"] for f in fields)
             self.sync += [
                 phase.rddata_en.eq(rddata_ens[sel]),
                 phase.wrdata_en.eq(wrdata_ens[sel])
@@ -137,7 +161,14 @@ class _Steerer(Module):
 
 
 class tFAWController(Module):
-    def __init__(self, tfaw):
+    """tFAW controller
+
+    Counts the activates in a window of tfaw cycles. With incremental, the
+    count is a register updated with the activates entering and leaving the
+    window instead of an adder tree over the window (shorter activate path at
+    large tfaw values).
+    """
+    def __init__(self, tfaw, incremental=False):
         self.valid = valid = Signal()
         self.ready = ready = Signal(reset=1)
         ready.attr.add("no_retiming")
@@ -145,10 +176,18 @@ class tFAWController(Module):
         # # #
 
         if tfaw is not None:
-            count = Signal(max=max(tfaw, 2))
+            count = Signal(max=max(tfaw+1, 2))
             window = Signal(tfaw)
             self.sync += window.eq(Cat(valid, window))
-            self.comb += count.eq(reduce(add, [window[i] for i in range(tfaw)]))
+            if incremental:
+                self.sync += \
+                    If(valid & ~window[-1],
+                        count.eq(count + 1)
+                    ).Elif(~valid & window[-1],
+                        count.eq(count - 1)
+                    )
+            else:
+                self.comb += count.eq(reduce(add, [window[i] for i in range(tfaw)]))
             self.sync += \
                 If(count < 4,
                     If(count == 3,
@@ -171,51 +210,143 @@ class Multiplexer(Module, AutoCSR):
         ras_allowed = Signal(reset=1)
         cas_allowed = Signal(reset=1)
 
+        # Bank groups (DDR4)
+        # Commands to the same bank group are spaced by tCCD/tRRD/tWTR (_L timings),
+        # commands to different bank groups by tCCD_S/tRRD_S/tWTR_S: requests to
+        # bank groups still waiting for their _L timings are masked from the
+        # choosers, which then alternate bank groups.
+        nbanks_per_rank = 2**settings.geom.bankbits
+        # bank machines dynamically bound to the banks (BankBinder)
+        virtual = len(bank_machines) < settings.phy.nranks*nbanks_per_rank
+        nbank_groups = 1
+        if settings.phy.memtype == "DDR4":
+            nbank_groups = nbanks_per_rank//4
+        if not any(getattr(settings.timing, t + "_S", None) is not None for t in ["tCCD", "tRRD", "tWTR"]):
+            nbank_groups = 1
+        def bank_group(ba):
+            return ba[2:settings.geom.bankbits]
+
+        def timing(name):
+            return get_runtime_setting(settings, name, getattr(settings.timing, name))
+
+        def timing_s(name):
+            t = getattr(settings.timing, name + "_S", None) if nbank_groups > 1 else None
+            return timing(name) if t is None else t
+
+        def bank_group_controllers(txxd, readys, valid):
+            for g, ready in enumerate(readys):
+                txxdcon = tXXDController(txxd)
+                self.submodules += txxdcon
+                self.comb += [
+                    txxdcon.valid.eq(valid(g)),
+                    ready.eq(txxdcon.ready)
+                ]
+
         # Command choosing
         requests = [bm.cmd for bm in bank_machines]
-        self.submodules.choose_cmd = choose_cmd = _CommandChooser(requests)
-        self.submodules.choose_req = choose_req = _CommandChooser(requests)
+        allowed = None
+        if nbank_groups > 1:
+            group_cas_allowed = [Signal(reset=1) for g in range(nbank_groups)]
+            group_read_allowed = [Signal(reset=1) for g in range(nbank_groups)]
+            group_ras_allowed = [Signal(reset=1) for g in range(nbank_groups)]
+            allowed = []
+            for n, request in enumerate(requests):
+                if virtual:
+                    g = bank_group(request.ba)
+                    cas_allowed_g, read_allowed_g, ras_allowed_g = [Array(a)[g]
+                        for a in [group_cas_allowed, group_read_allowed, group_ras_allowed]]
+                else:
+                    g = (n%nbanks_per_rank)//4
+                    cas_allowed_g = group_cas_allowed[g]
+                    read_allowed_g = group_read_allowed[g]
+                    ras_allowed_g = group_ras_allowed[g]
+                is_act_cmd = request.ras & ~request.cas & ~request.we
+                request_allowed = Signal()
+                self.comb += request_allowed.eq(
+                    (~request.cas | cas_allowed_g) &
+                    (~request.is_read | read_allowed_g) &
+                    (~is_act_cmd | ras_allowed_g))
+                allowed.append(request_allowed)
+        self.submodules.choose_req = choose_req = _CommandChooser(requests, allowed)
         if settings.phy.nphases == 1:
+            # Only one phase: all commands are steered from choose_req
+            choose_cmd = choose_req
             self.comb += [
-                choose_cmd.want_cmds.eq(1),
-                choose_cmd.want_activates.eq(ras_allowed),
                 choose_req.want_cmds.eq(1),
                 choose_req.want_activates.eq(ras_allowed),
             ]
+            choose_cmds = [choose_cmd]
+        else:
+            # Multi-command issue: bank machines are distributed over several
+            # command choosers, each steered to one of the phases left free by
+            # the CAS and command phases. Only one activate is accepted per sys
+            # clk cycle (see below): the extra slots are used by precharges.
+            ncmd_choosers = 1
+            if settings.with_multi_cmd:
+                ncmd_choosers = max(min(settings.phy.nphases - 1, len(requests)), 1)
+            choose_cmds = [_CommandChooser(requests[i::ncmd_choosers],
+                None if allowed is None else allowed[i::ncmd_choosers])
+                for i in range(ncmd_choosers)]
+            self.submodules.choose_cmd = choose_cmd = choose_cmds[0]
+            self.submodules += choose_cmds[1:]
 
         # Command steering
         nop = Record(cmd_request_layout(settings.geom.addressbits,
-                                        log2_int(len(bank_machines))))
+                                        len(requests[0].ba)))
         # nop must be 1st
         commands = [nop, choose_cmd.cmd, choose_req.cmd, refresher.cmd]
-        steerer = _Steerer(commands, dfi)
+        commands += [c.cmd for c in choose_cmds[1:]]
+        steerer = _Steerer(commands, dfi, refresh_all_ranks=settings.refresh_mode == "all",
+            registered=settings.with_registered_steerer)
         self.submodules += steerer
 
+        # Activates (at most one per sys clk cycle)
+        # tRRD/tFAW are tracked in sys clk cycles: tRRD being at least 4 DRAM
+        # clk cycles on DDR3/DDR4 (one sys clk cycle on 1:4 PHYs), one activate
+        # per sys clk cycle is already the maximum activate rate.
+        activates = [c.accept() & c.activate() for c in choose_cmds]
+        activates_allowed = [ras_allowed]
+        for i in range(1, len(choose_cmds)):
+            activate_allowed = Signal()
+            self.comb += activate_allowed.eq(ras_allowed & ~reduce(or_, activates[:i]))
+            activates_allowed.append(activate_allowed)
+
         # tRRD timing (Row to Row delay)
-        self.submodules.trrdcon = trrdcon = tXXDController(settings.timing.tRRD)
-        self.comb += trrdcon.valid.eq(choose_cmd.accept() & choose_cmd.activate())
+        self.submodules.trrdcon = trrdcon = tXXDController(timing_s("tRRD"))
+        self.comb += trrdcon.valid.eq(reduce(or_, activates))
+        if nbank_groups > 1:
+            bank_group_controllers(timing("tRRD"), group_ras_allowed,
+                lambda g: reduce(or_, [a & (bank_group(c.cmd.ba) == g)
+                    for a, c in zip(activates, choose_cmds)]))
 
         # tFAW timing (Four Activate Window)
-        self.submodules.tfawcon = tfawcon = tFAWController(settings.timing.tFAW)
-        self.comb += tfawcon.valid.eq(choose_cmd.accept() & choose_cmd.activate())
+        self.submodules.tfawcon = tfawcon = tFAWController(settings.timing.tFAW,
+            incremental=settings.with_incremental_tfaw)
+        self.comb += tfawcon.valid.eq(reduce(or_, activates))
 
         # RAS control
         self.comb += ras_allowed.eq(trrdcon.ready & tfawcon.ready)
 
         # tCCD timing (Column to Column delay)
-        self.submodules.tccdcon = tccdcon = tXXDController(settings.timing.tCCD)
+        self.submodules.tccdcon = tccdcon = tXXDController(timing_s("tCCD"))
         self.comb += tccdcon.valid.eq(choose_req.accept() & (choose_req.write() | choose_req.read()))
+        if nbank_groups > 1:
+            bank_group_controllers(timing("tCCD"), group_cas_allowed,
+                lambda g: tccdcon.valid & (bank_group(choose_req.cmd.ba) == g))
 
         # CAS control
         self.comb += cas_allowed.eq(tccdcon.ready)
 
         # tWTR timing (Write to Read delay)
         write_latency = math.ceil(settings.phy.cwl / settings.phy.nphases)
-        self.submodules.twtrcon = twtrcon = tXXDController(
-            settings.timing.tWTR + write_latency +
+        def twtr(twtr):
             # tCCD must be added since tWTR begins after the transfer is complete
-            settings.timing.tCCD if settings.timing.tCCD is not None else 0)
+            return twtr + write_latency + (timing("tCCD") if settings.timing.tCCD is not None else 0)
+        self.submodules.twtrcon = twtrcon = tXXDController(twtr(timing_s("tWTR")))
         self.comb += twtrcon.valid.eq(choose_req.accept() & choose_req.write())
+        if nbank_groups > 1:
+            bank_group_controllers(twtr(timing("tWTR")), group_read_allowed,
+                lambda g: twtrcon.valid & (bank_group(choose_req.cmd.ba) == g))
 
         # Read/write turnaround
         read_available = Signal()
@@ -230,27 +361,68 @@ class Multiplexer(Module, AutoCSR):
         def anti_starvation(timeout):
             en = Signal()
             max_time = Signal()
-            if timeout:
+            if isinstance(timeout, int) and not timeout:
+                self.comb += max_time.eq(0)
+            else:
                 t = timeout - 1
-                time = Signal(max=t+1)
-                self.comb += max_time.eq(time == 0)
+                if isinstance(timeout, int):
+                    time = Signal(max=t+1)
+                    self.comb += max_time.eq(time == 0)
+                else:
+                    # runtime timeout (0: no limit)
+                    time = Signal(len(timeout))
+                    self.comb += max_time.eq((time == 0) & (timeout != 0))
                 self.sync += If(~en,
                         time.eq(t)
                     ).Elif(~max_time,
                         time.eq(time - 1)
                     )
-            else:
-                self.comb += max_time.eq(0)
             return en, max_time
 
-        read_time_en, max_read_time = anti_starvation(settings.read_time)
-        write_time_en, max_write_time = anti_starvation(settings.write_time)
+        read_time_en, max_read_time = anti_starvation(
+            get_runtime_setting(settings, "read_time", settings.read_time))
+        write_time_en, max_write_time = anti_starvation(
+            get_runtime_setting(settings, "write_time", settings.write_time))
+
+        # Write watermarks:
+        # writes are buffered in the bank machines while reads are served and
+        # drained in batches: switch to writes when the number of pending
+        # writes reaches the high watermark (or when no bank machine has a read
+        # as next command) and back to reads when it falls to the low watermark
+        # (or when no bank machine has a write as next command), reducing the
+        # number of read/write turnarounds. Reads/writes queued behind the other
+        # type in a bank machine can't be issued and don't hold the drain.
+        write_drain_start = Signal()
+        write_drain_stop = Signal()
+        if settings.write_high_watermark:
+            assert settings.write_low_watermark < settings.write_high_watermark
+            nmax = len(bank_machines)*(get_cmd_queue_depth(settings)+2)
+            nwrites = Signal(max=nmax+1)
+            reads_next = reduce(or_, [bm.read_next for bm in bank_machines])
+            writes_next = reduce(or_, [bm.write_next for bm in bank_machines])
+            self.comb += [
+                nwrites.eq(reduce(add, [bm.nwrites for bm in bank_machines])),
+                write_drain_start.eq((nwrites >= settings.write_high_watermark) | ~reads_next),
+                write_drain_stop.eq((nwrites <= settings.write_low_watermark) | ~writes_next)
+            ]
+        else:
+            self.comb += [
+                write_drain_start.eq(~read_available),
+                write_drain_stop.eq(~write_available)
+            ]
 
         # Refresh
-        self.comb += [bm.refresh_req.eq(refresher.cmd.valid) for bm in bank_machines]
+        if virtual and settings.phy.nranks > 1:
+            ranks = Array(refresher.ranks[i] for i in range(settings.phy.nranks))
+            bm_refresh_reqs = [ranks[bm.bank[settings.geom.bankbits:]] for bm in bank_machines]
+        else:
+            bm_refresh_reqs = [refresher.ranks[n//nbanks_per_rank] for n in range(len(bank_machines))]
+        self.comb += [bm.refresh_req.eq(req) for bm, req in zip(bank_machines, bm_refresh_reqs)]
+        banks = [getattr(interface, "bank"+str(i)) for i in range(interface.nbanks)]
+        self.comb += refresher.idle.eq(~reduce(or_, [bank.valid | bank.lock for bank in banks]))
         go_to_refresh = Signal()
-        bm_refresh_gnts = [bm.refresh_gnt for bm in bank_machines]
-        self.comb += go_to_refresh.eq(reduce(and_, bm_refresh_gnts))
+        bm_refresh_gnts = [bm.refresh_gnt | ~req for bm, req in zip(bank_machines, bm_refresh_reqs)]
+        self.comb += go_to_refresh.eq(refresher.cmd.valid & reduce(and_, bm_refresh_gnts))
 
         # Datapath
         all_rddata = [p.rddata for p in dfi.phases]
@@ -264,18 +436,23 @@ class Multiplexer(Module, AutoCSR):
 
         def steerer_sel(steerer, r_w_n):
             r = []
+            # additional command choosers are steered to the free phases
+            extra_cmds = iter(range(STEER_REFRESH + 1, len(commands)))
             for i in range(settings.phy.nphases):
-                s = steerer.sel[i].eq(STEER_NOP)
                 if r_w_n == "read":
                     if i == settings.phy.rdphase:
                         s = steerer.sel[i].eq(STEER_REQ)
                     elif i == settings.phy.rdcmdphase:
                         s = steerer.sel[i].eq(STEER_CMD)
+                    else:
+                        s = steerer.sel[i].eq(next(extra_cmds, STEER_NOP))
                 elif r_w_n == "write":
                     if i == settings.phy.wrphase:
                         s = steerer.sel[i].eq(STEER_REQ)
                     elif i == settings.phy.wrcmdphase:
                         s = steerer.sel[i].eq(STEER_CMD)
+                    else:
+                        s = steerer.sel[i].eq(next(extra_cmds, STEER_NOP))
                 else:
                     raise ValueError
                 r.append(s)
@@ -286,13 +463,13 @@ class Multiplexer(Module, AutoCSR):
         fsm.act("READ",
             read_time_en.eq(1),
             choose_req.want_reads.eq(1),
-            choose_cmd.want_activates.eq(ras_allowed),
-            choose_cmd.cmd.ready.eq(~choose_cmd.activate() | ras_allowed),
+            [c.want_activates.eq(allowed) for c, allowed in zip(choose_cmds, activates_allowed)],
+            [c.cmd.ready.eq(~c.activate() | allowed) for c, allowed in zip(choose_cmds, activates_allowed)],
             choose_req.cmd.ready.eq(cas_allowed),
             steerer_sel(steerer, "read"),
             If(write_available,
                 # TODO: switch only after several cycles of ~read_available?
-                If(~read_available | max_read_time,
+                If(write_drain_start | max_read_time,
                     NextState("RTW")
                 )
             ),
@@ -303,12 +480,12 @@ class Multiplexer(Module, AutoCSR):
         fsm.act("WRITE",
             write_time_en.eq(1),
             choose_req.want_writes.eq(1),
-            choose_cmd.want_activates.eq(ras_allowed),
-            choose_cmd.cmd.ready.eq(~choose_cmd.activate() | ras_allowed),
+            [c.want_activates.eq(allowed) for c, allowed in zip(choose_cmds, activates_allowed)],
+            [c.cmd.ready.eq(~c.activate() | allowed) for c, allowed in zip(choose_cmds, activates_allowed)],
             choose_req.cmd.ready.eq(cas_allowed),
             steerer_sel(steerer, "write"),
             If(read_available,
-                If(~write_available | max_write_time,
+                If(write_drain_stop | max_write_time,
                     NextState("WTR")
                 )
             ),
@@ -328,9 +505,49 @@ class Multiplexer(Module, AutoCSR):
                 NextState("READ")
             )
         )
-        # TODO: reduce this, actual limit is around (cl+1)/nphases
-        fsm.delayed_enter("RTW", "WRITE", settings.phy.read_latency-1)
+        fsm.delayed_enter("RTW", "WRITE", get_rtw_latency(settings.phy)-1)
 
         if settings.with_bandwidth:
             data_width = settings.phy.dfi_databits*settings.phy.nphases
-            self.submodules.bandwidth = Bandwidth(self.choose_req.cmd, data_width)
+            # refreshes counters only when refreshes can be started early/postponed
+            with_refresh_counters = settings.refresh_window or settings.refresh_postponing
+            self.submodules.bandwidth = Bandwidth(self.choose_req.cmd, data_width,
+                refresher=refresher if with_refresh_counters else None)
+
+        if settings.with_perfmon:
+            def entering(state):
+                ongoing = Signal()
+                ongoing_d = Signal()
+                self.comb += ongoing.eq(fsm.ongoing(state))
+                self.sync += ongoing_d.eq(ongoing)
+                return ongoing & ~ongoing_d
+
+            def dfi_commands(ras, cas, we):
+                return reduce(add, [(phase.ras_n == (not ras)) & (phase.cas_n == (not cas)) &
+                    (phase.we_n == (not we)) for phase in dfi.phases])
+
+            # commands blocked by the tRRD/tFAW/tCCD timings
+            activate_pending = reduce(or_, [req.valid & req.ras & ~req.cas & ~req.we for req in requests])
+            cas_pending = reduce(or_, [req.valid &
+                ((fsm.ongoing("READ") & req.is_read) | (fsm.ongoing("WRITE") & req.is_write))
+                for req in requests])
+            activate_stall = Signal()
+            self.comb += activate_stall.eq(activate_pending & (fsm.ongoing("READ") | fsm.ongoing("WRITE")))
+
+            events = [
+                ("activates",                 dfi_commands(ras=1, cas=0, we=0)),
+                ("precharges",                dfi_commands(ras=1, cas=0, we=1)),
+                ("refresh_stall_cycles",      refresher.ranks != 0),
+                ("read_to_write_turnarounds", entering("WRITE")),
+                ("write_to_read_turnarounds", entering("WTR")),
+                ("trrd_stall_cycles",         activate_stall & ~trrdcon.ready),
+                ("tfaw_stall_cycles",         activate_stall & ~tfawcon.ready),
+                ("tccd_stall_cycles",         cas_pending & ~tccdcon.ready),
+            ]
+            for n, bm in enumerate(bank_machines):
+                events += [
+                    ("bank{}_row_hits".format(n),      bm.row_hit),
+                    ("bank{}_row_misses".format(n),    bm.row_miss),
+                    ("bank{}_row_conflicts".format(n), bm.row_conflict),
+                ]
+            self.submodules.perfmon = PerformanceMonitor(events)
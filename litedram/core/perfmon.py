@@ -0,0 +1,35 @@
+"""LiteDRAM Performance Monitor."""
+
+from migen import *
+
+from litex.soc.interconnect.csr import *
+
+
+class PerformanceMonitor(Module, AutoCSR):
+    """Event counters
+
+    Counts the given events: (name, signal) pairs, a signal of n bits counting
+    up to 2**n-1 events per cycle. Counters run freely: a write to snapshot
+    copies all of them to their CSRs at once (coherent readout), a write to
+    clear resets them.
+    """
+    def __init__(self, events, counter_bits=32):
+        self.snapshot = CSR(name="snapshot")
+        self.clear = CSR(name="clear")
+
+        # # #
+
+        for name, event in events:
+            csr = CSRStatus(counter_bits, name=name)
+            setattr(self, name, csr)
+            counter = Signal(counter_bits)
+            self.sync += [
+                If(self.clear.re,
+                    counter.eq(0)
+                ).Else(
+                    counter.eq(counter + event)
+                ),
+                If(self.snapshot.re,
+                    csr.status.eq(counter)
+                )
+            ]
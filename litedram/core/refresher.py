@@ -13,11 +13,38 @@ class Refresher(Module):
         # 1st command 1 cycle after assertion of ready
         self.cmd = cmd = stream.Endpoint(cmd_request_rw_layout(
             settings.geom.addressbits, settings.geom.bankbits + log2_int(settings.phy.nranks)))
+        # no pending traffic on the controller (driven by the multiplexer)
+        self.idle = Signal()
+        # ranks being refreshed, their bank machines have to stay in REFRESH
+        self.ranks = Signal(settings.phy.nranks)
+        # refresh started ahead of / at its deadline (for statistics)
+        self.early = Signal()
+        self.forced = Signal()
 
         # # #
 
+        nranks = settings.phy.nranks
+        tRP = settings.timing.tRP
+        tRFC = settings.timing.tRFC
+
         # Refresh sequence generator:
-        # PRECHARGE ALL --(tRP)--> AUTO REFRESH --(tRFC)--> done
+        # "all":  PRECHARGE ALL --(tRP)--> AUTO REFRESH --(tRFC)--> done
+        #         on all ranks.
+        # "rank": PRECHARGE ALL --(tRP)--> AUTO REFRESH --> done
+        #         on one rank (ranks refreshed in turn). The multiplexer is
+        #         released after the AUTO REFRESH while the bank machines of
+        #         the refreshed rank stay in REFRESH until tRFC is elapsed:
+        #         other ranks can be accessed during tRFC.
+        if settings.refresh_mode == "all":
+            seq_length = 1 + tRP + tRFC
+            refresh_period = settings.timing.tREFI
+        elif settings.refresh_mode == "rank":
+            seq_length = 1 + tRP + 1
+            refresh_period = settings.timing.tREFI//nranks
+        else:
+            raise ValueError("Unsupported refresh mode: {}".format(settings.refresh_mode))
+
+        rank = Signal(max=max(nranks, 2))
         seq_start = Signal()
         seq_done = Signal()
         self.sync += [
@@ -28,28 +55,99 @@ class Refresher(Module):
             cmd.we.eq(0),
             seq_done.eq(0)
         ]
+        if settings.refresh_mode == "rank" and nranks > 1:
+            self.sync += cmd.ba[settings.geom.bankbits:].eq(rank)
         self.sync += timeline(seq_start, [
             (1, [
                 cmd.ras.eq(1),
                 cmd.we.eq(1)
             ]),
-            (1+settings.timing.tRP, [
+            (1+tRP, [
                 cmd.cas.eq(1),
                 cmd.ras.eq(1)
             ]),
-            (1+settings.timing.tRP+settings.timing.tRFC, [
+            (seq_length, [
                 seq_done.eq(1)
             ])
         ])
 
+        if settings.refresh_mode == "rank":
+            if nranks > 1:
+                self.sync += If(cmd.last, rank.eq(rank + 1))
+            for i in range(nranks):
+                trfc = Signal(max=tRFC+1)
+                self.sync += \
+                    If(cmd.cas & cmd.ras & (rank == i),
+                        trfc.eq(tRFC)
+                    ).Elif(trfc != 0,
+                        trfc.eq(trfc - 1)
+                    )
+                self.comb += self.ranks[i].eq((cmd.valid & (rank == i)) | (trfc != 0))
+        else:
+            self.comb += self.ranks.eq(Replicate(cmd.valid, nranks))
+
         # Periodic refresh counter
-        self.submodules.timer = WaitTimer(settings.timing.tREFI)
-        self.comb += self.timer.wait.eq(settings.with_refresh & ~self.timer.done)
+        tick = Signal()
+        self.submodules.timer = WaitTimer(refresh_period)
+        self.comb += self.timer.wait.eq(settings.with_refresh & ~tick)
+
+        # Opportunistic refresh:
+        # when the controller has been idle for refresh_idle_threshold cycles
+        # and a refresh is due within refresh_window cycles, start it early
+        # (and restart the refresh period) to hide tRFC in the idle gap.
+        early = Signal()
+        window_ok = Signal()
+        if settings.refresh_window:
+            assert settings.refresh_window < refresh_period
+            self.submodules.window_timer = WaitTimer(refresh_period - settings.refresh_window)
+            self.comb += self.window_timer.wait.eq(settings.with_refresh & ~tick)
+            idle_count = Signal(max=settings.refresh_idle_threshold+1)
+            self.sync += \
+                If(~self.idle,
+                    idle_count.eq(0)
+                ).Elif(idle_count != settings.refresh_idle_threshold,
+                    idle_count.eq(idle_count + 1)
+                )
+            self.comb += window_ok.eq(self.window_timer.done & ~self.timer.done &
+                (idle_count == settings.refresh_idle_threshold))
+        self.comb += tick.eq(self.timer.done | early)
+
+        # Refresh postponing / pulling-in:
+        # credit is decremented when a refresh is due and incremented when a
+        # refresh is done. Refreshes are postponed while the controller has
+        # pending traffic (up to refresh_postponing), and done (or pulled-in, up
+        # to refresh_postponing) in bursts while the controller is idle.
+        refresh = Signal()
+        forced = Signal()
+        if settings.refresh_postponing:
+            assert settings.refresh_postponing <= 8
+            n = settings.refresh_postponing
+            if settings.refresh_mode == "rank":
+                n *= nranks
+            credit = Signal(min=-n-1, max=n+1)
+            self.sync += \
+                If(tick & ~cmd.last,
+                    credit.eq(credit - 1)
+                ).Elif(cmd.last & ~tick,
+                    credit.eq(credit + 1)
+                )
+            self.comb += [
+                refresh.eq(settings.with_refresh &
+                    ((credit <= -n) | (self.idle & (credit < n)))),
+                forced.eq(credit <= -n)
+            ]
+        else:
+            self.comb += [
+                refresh.eq(tick),
+                forced.eq(self.timer.done)
+            ]
 
         # Control FSM
         self.submodules.fsm = fsm = FSM()
         fsm.act("IDLE",
-            If(self.timer.done,
+            If(refresh,
+                self.early.eq(~forced),
+                self.forced.eq(forced),
                 NextState("WAIT_GRANT")
             )
         )
@@ -68,3 +166,4 @@ class Refresher(Module):
                 cmd.valid.eq(1)
             )
         )
+        self.comb += early.eq(window_ok & fsm.ongoing("IDLE"))
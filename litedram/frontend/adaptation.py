@@ -13,6 +13,7 @@ class LiteDRAMNativePortCDC(Module):
         assert port_from.address_width == port_to.address_width
         assert port_from.data_width == port_to.data_width
         assert port_from.mode == port_to.mode
+        assert port_from.len_bits == port_to.len_bits
 
         address_width = port_from.address_width
         data_width = port_from.data_width
@@ -23,7 +24,7 @@ class LiteDRAMNativePortCDC(Module):
         # # #
 
         cmd_fifo = stream.AsyncFIFO(
-            [("we", 1), ("addr", address_width)], cmd_depth)
+            cmd_description(address_width, port_from.len_bits), cmd_depth)
         cmd_fifo = ClockDomainsRenamer(
             {"write": clock_domain_from,
              "read":  clock_domain_to})(cmd_fifo)
@@ -51,6 +52,54 @@ class LiteDRAMNativePortCDC(Module):
                 port_to.rdata, rdata_fifo, port_from.rdata)
 
 
+class LiteDRAMNativePortBurstExpander(Module):
+    """LiteDRAM port burst expander
+
+    Expands the burst commands of port_from (len+1 consecutive words from addr)
+    in single word commands to port_to, at one command per cycle. A burst
+    command is accepted (registered) before its words are issued: its data
+    follows the handshake as for a single word command. Data is passed through.
+    """
+    def __init__(self, port_from, port_to):
+        assert port_from.clock_domain == port_to.clock_domain
+        assert port_from.address_width == port_to.address_width
+        assert port_from.data_width == port_to.data_width
+        assert port_from.mode == port_to.mode
+        assert port_from.len_bits and not port_to.len_bits
+
+        # # #
+
+        mode = port_from.mode
+
+        busy = Signal()
+        remaining = Signal(port_from.len_bits)
+        last = Signal()
+        self.comb += [
+            last.eq(remaining == 0),
+            port_to.cmd.valid.eq(busy),
+            port_from.cmd.ready.eq(~busy | (port_to.cmd.ready & last))
+        ]
+        self.sync += [
+            If(port_from.cmd.valid & port_from.cmd.ready,
+                busy.eq(1),
+                port_to.cmd.we.eq(port_from.cmd.we),
+                port_to.cmd.addr.eq(port_from.cmd.addr),
+                remaining.eq(port_from.cmd.len)
+            ).Elif(port_to.cmd.valid & port_to.cmd.ready,
+                If(last,
+                    busy.eq(0)
+                ),
+                port_to.cmd.addr.eq(port_to.cmd.addr + 1),
+                remaining.eq(remaining - 1)
+            )
+        ]
+
+        if mode == "write" or mode == "both":
+            self.comb += port_from.wdata.connect(port_to.wdata)
+        if mode == "read" or mode == "both":
+            self.comb += port_to.rdata.connect(port_from.rdata)
+
+
 class LiteDRAMNativePortDownConverter(Module):
     """LiteDRAM port DownConverter
 
@@ -7,6 +7,7 @@ Features:
 - Write/Read arbitration.
 - Write/Read data buffers (configurable depth).
 - Burst support (FIXED/INCR/WRAP).
+- INCR bursts of full words issued in a single command on Native ports with a len field.
 - ID support (configurable width).
 
 Limitations:
@@ -140,6 +141,11 @@ class LiteDRAMAXIBurst2Beat(Module):
         )
 
 
+def _native_burst(ax, ashift, max_len):
+    # INCR burst of full words that can be issued in a single Native command
+    return (ax.burst == burst_types["incr"]) & (ax.size == ashift) & (ax.len < max_len)
+
+
 class LiteDRAMAXI2NativeW(Module):
     def __init__(self, axi, port, buffer_depth):
         self.cmd_request = Signal()
@@ -152,10 +158,24 @@ class LiteDRAMAXI2NativeW(Module):
         # Burst to Beat
         aw_buffer = stream.Buffer(ax_description(axi.address_width, axi.id_width))
         self.comb += axi.aw.connect(aw_buffer.sink)
+        aw_split = stream.Endpoint(ax_description(axi.address_width, axi.id_width))
         aw = stream.Endpoint(ax_description(axi.address_width, axi.id_width))
-        aw_burst2beat = LiteDRAMAXIBurst2Beat(aw_buffer.source, aw)
+        aw_burst2beat = LiteDRAMAXIBurst2Beat(aw_split, aw)
         self.submodules += aw_buffer, aw_burst2beat
 
+        # Burst commands (bursts not split in beats)
+        aw_burst = Signal()
+        if port.len_bits:
+            assert buffer_depth >= 2
+            self.comb += aw_burst.eq(_native_burst(aw_buffer.source, ashift,
+                min(2**port.len_bits, buffer_depth)))
+        self.comb += [
+            aw_buffer.source.connect(aw_split, omit={"valid", "ready"}),
+            If(~aw_burst,
+                aw_buffer.source.connect(aw_split, keep={"valid", "ready"})
+            )
+        ]
+
         # Write Buffer
         w_buffer = stream.SyncFIFO(w_description(axi.data_width), buffer_depth)
         self.submodules += w_buffer
@@ -167,6 +187,10 @@ class LiteDRAMAXI2NativeW(Module):
         self.comb += [
             id_buffer.sink.valid.eq(aw.valid & aw.first & aw.ready),
             id_buffer.sink.id.eq(aw.id),
+            If(aw_burst,
+                id_buffer.sink.valid.eq(aw_buffer.source.valid & aw_buffer.source.ready),
+                id_buffer.sink.id.eq(aw_buffer.source.id)
+            ),
             If(w_buffer.source.valid &
                w_buffer.source.last &
                w_buffer.source.ready,
@@ -179,9 +203,11 @@ class LiteDRAMAXI2NativeW(Module):
         ]
 
         # Command
+        w_available = Signal()
         self.comb += [
+            w_available.eq(w_buffer.source.valid),
             # Emits the command only if we have the data
-            If(w_buffer.source.valid,
+            If(w_available & ~aw_burst,
                 self.cmd_request.eq(aw.valid),
                 If(self.cmd_grant,
                     port.cmd.valid.eq(aw.valid),
@@ -191,6 +217,31 @@ class LiteDRAMAXI2NativeW(Module):
                 )
             )
         ]
+        if port.len_bits:
+            # Emits a burst command only if we have the data of the whole burst:
+            # buffered data not reserved by the previous commands
+            w_issued = Signal(max=buffer_depth + 1)
+            w_cmd_beats = Signal(max=buffer_depth + 1)
+            w_data_beat = Signal()
+            self.comb += [
+                If(port.cmd.valid & port.cmd.ready & port.cmd.we,
+                    w_cmd_beats.eq(port.cmd.len + 1)
+                ),
+                w_data_beat.eq(port.wdata.valid & port.wdata.ready),
+                w_available.eq(w_buffer.level > w_issued)
+            ]
+            self.sync += w_issued.eq(w_issued + w_cmd_beats - w_data_beat)
+            self.comb += \
+                If(aw_burst & (w_buffer.level >= w_issued + aw_buffer.source.len + 1),
+                    self.cmd_request.eq(aw_buffer.source.valid),
+                    If(self.cmd_grant,
+                        port.cmd.valid.eq(aw_buffer.source.valid),
+                        aw_buffer.source.ready.eq(port.cmd.ready),
+                        port.cmd.we.eq(1),
+                        port.cmd.addr.eq(aw_buffer.source.addr >> ashift),
+                        port.cmd.len.eq(aw_buffer.source.len)
+                    )
+                )
 
         # Write Data
         self.comb += [
@@ -216,10 +267,23 @@ class LiteDRAMAXI2NativeR(Module):
         # Burst to Beat
         ar_buffer = stream.Buffer(ax_description(axi.address_width, axi.id_width))
         self.comb += axi.ar.connect(ar_buffer.sink)
+        ar_split = stream.Endpoint(ax_description(axi.address_width, axi.id_width))
         ar = stream.Endpoint(ax_description(axi.address_width, axi.id_width))
-        ar_burst2beat = LiteDRAMAXIBurst2Beat(ar_buffer.source, ar)
+        ar_burst2beat = LiteDRAMAXIBurst2Beat(ar_split, ar)
         self.submodules += ar_buffer, ar_burst2beat
 
+        # Burst commands (bursts not split in beats)
+        ar_burst = Signal()
+        if port.len_bits:
+            self.comb += ar_burst.eq(_native_burst(ar_buffer.source, ashift,
+                min(2**port.len_bits, buffer_depth)))
+        self.comb += [
+            ar_buffer.source.connect(ar_split, omit={"valid", "ready"}),
+            If(~ar_burst,
+                ar_buffer.source.connect(ar_split, keep={"valid", "ready"})
+            )
+        ]
+
         # Read buffer
         r_buffer = stream.SyncFIFO(r_description(axi.data_width, axi.id_width), buffer_depth)
         self.submodules += r_buffer
@@ -234,26 +298,65 @@ class LiteDRAMAXI2NativeR(Module):
             r_buffer_queue.eq(port.cmd.valid & port.cmd.ready & ~port.cmd.we),
             r_buffer_dequeue.eq(r_buffer.source.valid & r_buffer.source.ready)
         ]
-        self.sync += [
-            If(r_buffer_queue,
-                If(~r_buffer_dequeue, r_buffer_level.eq(r_buffer_level + 1))
-            ).Elif(r_buffer_dequeue,
-                r_buffer_level.eq(r_buffer_level - 1)
-            )
-        ]
-        self.comb += can_read.eq(r_buffer_level != buffer_depth)
+        if port.len_bits:
+            # burst commands reserve the data of the whole burst
+            r_buffer_queue_len = Signal(port.len_bits)
+            self.comb += [
+                r_buffer_queue_len.eq(port.cmd.len),
+                can_read.eq(r_buffer_level + Mux(ar_burst, ar_buffer.source.len, 0) < buffer_depth)
+            ]
+            self.sync += \
+                If(r_buffer_queue,
+                    r_buffer_level.eq(r_buffer_level + r_buffer_queue_len + 1 - r_buffer_dequeue)
+                ).Elif(r_buffer_dequeue,
+                    r_buffer_level.eq(r_buffer_level - 1)
+                )
+        else:
+            self.sync += [
+                If(r_buffer_queue,
+                    If(~r_buffer_dequeue, r_buffer_level.eq(r_buffer_level + 1))
+                ).Elif(r_buffer_dequeue,
+                    r_buffer_level.eq(r_buffer_level - 1)
+                )
+            ]
+            self.comb += can_read.eq(r_buffer_level != buffer_depth)
 
         # Read ID Buffer
-        id_buffer = stream.SyncFIFO([("id", axi.id_width)], buffer_depth)
+        # (one entry per beat, or per burst for the burst commands)
+        id_layout = [("id", axi.id_width)]
+        id_last = 1 # last beat of the entry
+        if port.len_bits:
+            id_layout.append(("len", len(ar_buffer.source.len)))
+            id_last = Signal()
+        id_buffer = stream.SyncFIFO(id_layout, buffer_depth)
         self.submodules += id_buffer
         self.comb += [
             id_buffer.sink.valid.eq(ar.valid & ar.ready),
             id_buffer.sink.last.eq(ar.last),
             id_buffer.sink.id.eq(ar.id),
-            axi.r.last.eq(id_buffer.source.last),
+            axi.r.last.eq(id_buffer.source.last & id_last),
             axi.r.id.eq(id_buffer.source.id),
-            id_buffer.source.ready.eq(axi.r.valid & axi.r.ready)
+            id_buffer.source.ready.eq(axi.r.valid & axi.r.ready & id_last)
         ]
+        if port.len_bits:
+            id_count = Signal(len(ar_buffer.source.len))
+            self.comb += [
+                If(ar_burst,
+                    id_buffer.sink.valid.eq(ar_buffer.source.valid & ar_buffer.source.ready),
+                    id_buffer.sink.last.eq(1),
+                    id_buffer.sink.id.eq(ar_buffer.source.id),
+                    id_buffer.sink.len.eq(ar_buffer.source.len)
+                ),
+                id_last.eq(id_count == id_buffer.source.len)
+            ]
+            self.sync += \
+                If(axi.r.valid & axi.r.ready,
+                    If(id_last,
+                        id_count.eq(0)
+                    ).Else(
+                        id_count.eq(id_count + 1)
+                    )
+                )
 
         # Command
         self.comb += [
@@ -265,6 +368,18 @@ class LiteDRAMAXI2NativeR(Module):
                 port.cmd.addr.eq(ar.addr >> ashift)
             )
         ]
+        if port.len_bits:
+            self.comb += \
+                If(ar_burst,
+                    self.cmd_request.eq(ar_buffer.source.valid & can_read),
+                    If(self.cmd_grant,
+                        port.cmd.valid.eq(ar_buffer.source.valid & can_read),
+                        ar_buffer.source.ready.eq(port.cmd.ready & can_read),
+                        port.cmd.we.eq(0),
+                        port.cmd.addr.eq(ar_buffer.source.addr >> ashift),
+                        port.cmd.len.eq(ar_buffer.source.len)
+                    )
+                )
 
         # Read data
         self.comb += [
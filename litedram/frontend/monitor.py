@@ -0,0 +1,133 @@
+"""LiteDRAM native port latency monitor."""
+
+from migen import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
+
+
+class _LatencyStatistics(Module, AutoCSR):
+    """Latency statistics
+
+    Number of requests, total (mean = total/count), min and max latency and
+    log2 histogram: bucket 0 counts the latencies of 0 cycle, bucket i the
+    latencies in [2**(i-1), 2**i), the last bucket also counts the larger ones.
+    """
+    def __init__(self, latency_bits, nbuckets, counter_bits=32):
+        self.valid = Signal()
+        self.latency = Signal(latency_bits)
+        self.snapshot = Signal()
+        self.clear = Signal()
+
+        self.count = CSRStatus(counter_bits, name="count")
+        self.total = CSRStatus(counter_bits + latency_bits, name="total")
+        self.min = CSRStatus(latency_bits, name="min")
+        self.max = CSRStatus(latency_bits, name="max")
+        for i in range(nbuckets):
+            setattr(self, "bucket{}".format(i), CSRStatus(counter_bits, name="bucket{}".format(i)))
+
+        # # #
+
+        bucket = Signal(max=max(nbuckets, 2))
+        for i in range(1, nbuckets):
+            self.comb += If(self.latency >= 2**(i-1), bucket.eq(i))
+
+        count = Signal(counter_bits)
+        total = Signal(counter_bits + latency_bits)
+        min_latency = Signal(latency_bits, reset=2**latency_bits-1)
+        max_latency = Signal(latency_bits)
+        self.sync += [
+            If(self.clear,
+                count.eq(0),
+                total.eq(0),
+                min_latency.eq(min_latency.reset),
+                max_latency.eq(0)
+            ).Elif(self.valid,
+                count.eq(count + 1),
+                total.eq(total + self.latency),
+                If(self.latency < min_latency, min_latency.eq(self.latency)),
+                If(self.latency > max_latency, max_latency.eq(self.latency))
+            ),
+            If(self.snapshot,
+                self.count.status.eq(count),
+                self.total.status.eq(total),
+                self.min.status.eq(min_latency),
+                self.max.status.eq(max_latency)
+            )
+        ]
+        for i in range(nbuckets):
+            counter = Signal(counter_bits)
+            self.sync += [
+                If(self.clear,
+                    counter.eq(0)
+                ).Elif(self.valid & (bucket == i),
+                    counter.eq(counter + 1)
+                ),
+                If(self.snapshot,
+                    getattr(self, "bucket{}".format(i)).status.eq(counter)
+                )
+            ]
+
+
+class LiteDRAMNativePortLatencyMonitor(Module, AutoCSR):
+    """LiteDRAM native port latency monitor
+
+    Inserted between a user port and a crossbar port, measures the latency (in
+    clock cycles) of the reads (cmd to rdata handshakes) and of the writes (cmd
+    to wdata handshakes). Commands are timestamped in FIFOs of depth entries:
+    depth has to cover the outstanding commands of the port, the commands are
+    stalled otherwise. Latencies are counted modulo 2**latency_bits.
+
+    A write to snapshot copies the statistics to their CSRs, a write to clear
+    resets them.
+    """
+    def __init__(self, port_from, port_to, depth=32, latency_bits=16, nbuckets=16):
+        assert port_from.address_width == port_to.address_width
+        assert port_from.data_width == port_to.data_width
+        assert port_from.mode == port_to.mode
+        assert port_from.clock_domain == port_to.clock_domain
+
+        self.snapshot = CSR(name="snapshot")
+        self.clear = CSR(name="clear")
+
+        # # #
+
+        mode = port_from.mode
+
+        time = Signal(latency_bits)
+        self.sync += time.eq(time + 1)
+
+        cmd_readys = {}
+        for name, we, data in [("read", 0, port_from.rdata), ("write", 1, port_from.wdata)]:
+            if mode not in [name, "both"]:
+                continue
+            timestamps = stream.SyncFIFO([("time", latency_bits)], depth)
+            statistics = _LatencyStatistics(latency_bits, nbuckets)
+            self.submodules += timestamps
+            setattr(self.submodules, name, statistics)
+            cmd_readys[we] = timestamps.sink.ready
+
+            self.comb += [
+                timestamps.sink.valid.eq(port_from.cmd.valid & port_from.cmd.ready & (port_from.cmd.we == we)),
+                timestamps.sink.time.eq(time),
+                timestamps.source.ready.eq(data.valid & data.ready)
+            ]
+            self.sync += [
+                statistics.valid.eq(timestamps.source.valid & timestamps.source.ready),
+                statistics.latency.eq(time - timestamps.source.time),
+                statistics.snapshot.eq(self.snapshot.re),
+                statistics.clear.eq(self.clear.re)
+            ]
+
+        # commands stalled when their timestamps FIFO is full
+        cmd_ready = Signal()
+        self.comb += [
+            port_from.cmd.connect(port_to.cmd, omit={"valid", "ready"}),
+            cmd_ready.eq(Mux(port_from.cmd.we, cmd_readys.get(1, 0), cmd_readys.get(0, 0))),
+            port_to.cmd.valid.eq(port_from.cmd.valid & cmd_ready),
+            port_from.cmd.ready.eq(port_to.cmd.ready & cmd_ready)
+        ]
+        if mode in ["write", "both"]:
+            self.comb += port_from.wdata.connect(port_to.wdata)
+        if mode in ["read", "both"]:
+            self.comb += port_to.rdata.connect(port_from.rdata)
@@ -6,8 +6,10 @@ from migen import *
 from litedram.common import GeomSettings, TimingSettings
 
 
-_technology_timings = ["tREFI", "tWTR", "tCCD", "tRRD"]
+# tWTR_S, tCCD_S, tRRD_S: different bank groups timings (DDR4), optional
+_technology_timings = ["tREFI", "tWTR", "tCCD", "tRRD", "tWTR_S", "tCCD_S", "tRRD_S"]
 _TechnologyTimings = namedtuple("TechnologyTimings", _technology_timings)
+_TechnologyTimings.__new__.__defaults__ = (None, None, None)
 _speedgrade_timings = ["tRP", "tRCD", "tWR", "tRFC", "tFAW", "tRAS"]
 _SpeedgradeTimings = namedtuple("SpeedgradeTimings", _speedgrade_timings)
 
@@ -43,7 +45,10 @@ class SDRAMModule:
             tCCD=None if self.get("tCCD") is None else self.ck_ns_to_cycles(*self.get("tCCD")),
             tRRD=None if self.get("tRRD") is None else self.ck_ns_to_cycles(*self.get("tRRD")),
             tRC=None if self.get("tRAS") is None else self.ns_to_cycles(self.get("tRP") + self.get("tRAS")),
-            tRAS=None if self.get("tRAS") is None else self.ns_to_cycles(self.get("tRAS"))
+            tRAS=None if self.get("tRAS") is None else self.ns_to_cycles(self.get("tRAS")),
+            tWTR_S=None if self.get("tWTR_S") is None else self.ck_ns_to_cycles(*self.get("tWTR_S")),
+            tCCD_S=None if self.get("tCCD_S") is None else self.ck_ns_to_cycles(*self.get("tCCD_S")),
+            tRRD_S=None if self.get("tRRD_S") is None else self.ck_ns_to_cycles(*self.get("tRRD_S"))
         )
 
     def get(self, name):
@@ -375,7 +380,8 @@ class EDY4016A(SDRAMModule):
     nrows  = 32768
     ncols  = 1024
     # timings
-    technology_timings = _TechnologyTimings(tREFI=64e6/8192, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9))
+    technology_timings = _TechnologyTimings(tREFI=64e6/8192, tWTR=(4, 7.5), tCCD=(5, 5), tRRD=(4, 4.9),
+        tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.3))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=260, tFAW=(28, 30), tRAS=32),
     }
@@ -389,7 +395,8 @@ class MT40A1G8(SDRAMModule):
     nrows  = 65536
     ncols  = 1024
     # timings
-    technology_timings = _TechnologyTimings(tREFI=64e6/8192, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9))
+    technology_timings = _TechnologyTimings(tREFI=64e6/8192, tWTR=(4, 7.5), tCCD=(5, 5), tRRD=(4, 4.9),
+        tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.3))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=350, tFAW=(20, 25), tRAS=32),
     }
@@ -2,7 +2,7 @@
 # License: BSD
 
 # SDRAM simulation PHY at DFI level
-# tested with SDR/DDR/DDR2/LPDDR/DDR3
+# tested with SDR/DDR/DDR2/LPDDR/DDR3/DDR4
 # TODO:
 # - add $display support to LiteX gen and manage timing violations?
 
@@ -42,13 +42,15 @@ class Bank(Module):
                 row.eq(self.activate_row)
             )
 
+        # one memory word per burst (low column address bits are 0)
+        col_shift = log2_int(burst_length)
         self.specials.mem = mem = Memory(data_width, nrows*ncols//burst_length)
         self.specials.write_port = write_port = mem.get_port(write_capable=True,
                                                              we_granularity=we_granularity)
         self.specials.read_port = read_port = mem.get_port(async_read=True)
         self.comb += [
             If(active,
-                write_port.adr.eq(row*ncols | self.write_col),
+                write_port.adr.eq(Cat(self.write_col[col_shift:], row)),
                 write_port.dat_w.eq(self.write_data),
                 If(we_granularity,
                     write_port.we.eq(Replicate(self.write, data_width//8) & ~self.write_mask),
@@ -56,7 +58,7 @@ class Bank(Module):
                     write_port.we.eq(self.write),
                 ),
                 If(self.read,
-                    read_port.adr.eq(row*ncols | self.read_col),
+                    read_port.adr.eq(Cat(self.read_col[col_shift:], row)),
                     self.read_data.eq(read_port.dat_r)
                 )
             )
@@ -64,7 +66,7 @@ class Bank(Module):
 
 
 class DFIPhase(Module):
-    def __init__(self, dfi, n):
+    def __init__(self, dfi, n, rank=0):
         phase = getattr(dfi, "p"+str(n))
 
         self.bank = phase.bank
@@ -83,12 +85,13 @@ class DFIPhase(Module):
 
         # # #
 
+        cs = ~phase.cs_n[rank]
         self.comb += [
-            If(~phase.cs_n & ~phase.ras_n & phase.cas_n,
+            If(cs & ~phase.ras_n & phase.cas_n,
                 self.activate.eq(phase.we_n),
                 self.precharge.eq(~phase.we_n)
             ),
-            If(~phase.cs_n & phase.ras_n & ~phase.cas_n,
+            If(cs & phase.ras_n & ~phase.cas_n,
                 self.write.eq(~phase.we_n),
                 self.read.eq(phase.we_n)
             )
@@ -99,7 +102,7 @@ class SDRAMPHYModel(Module):
     def __init__(self, module, settings, we_granularity=8):
         if settings.memtype in ["SDR"]:
             burst_length = settings.nphases*1  # command multiplication*SDR
-        elif settings.memtype in ["DDR", "LPDDR", "DDR2", "DDR3"]:
+        elif settings.memtype in ["DDR", "LPDDR", "DDR2", "DDR3", "DDR4"]:
             burst_length = settings.nphases*2  # command multiplication*DDR
 
         addressbits = module.geom_settings.addressbits
@@ -119,15 +122,45 @@ class SDRAMPHYModel(Module):
         ncols = 2**colbits
         data_width = self.settings.dfi_databits*self.settings.nphases
 
-        # DFI phases
-        phases = [DFIPhase(self.dfi, n) for n in range(self.settings.nphases)]
-        self.submodules += phases
+        # banks (of all ranks)
+        banks = []
+        for rank in range(self.settings.nranks):
+            # DFI phases
+            phases = [DFIPhase(self.dfi, n, rank) for n in range(self.settings.nphases)]
+            self.submodules += phases
 
-        # banks
-        banks = [Bank(data_width, nrows, ncols, burst_length, we_granularity) for i in range(nbanks)]
-        self.submodules += banks
+            rank_banks = [Bank(data_width, nrows, ncols, burst_length, we_granularity) for i in range(nbanks)]
+            self.submodules += rank_banks
+            banks += rank_banks
 
-        # connect DFI phases to banks (cmds, write datapath)
+            # connect DFI phases to banks (cmds, write datapath)
+            self.connect_banks(phases, rank_banks)
+
+        # connect banks to DFI phases (cmds, read datapath)
+        banks_read = Signal()
+        banks_read_data = Signal(data_width)
+        self.comb += [
+            banks_read.eq(reduce(or_, [bank.read for bank in banks])),
+            banks_read_data.eq(reduce(or_, [bank.read_data for bank in banks]))
+        ]
+
+        # simulate read latency
+        for i in range(self.settings.read_latency):
+            new_banks_read = Signal()
+            new_banks_read_data = Signal(data_width)
+            self.sync += [
+                new_banks_read.eq(banks_read),
+                new_banks_read_data.eq(banks_read_data)
+            ]
+            banks_read = new_banks_read
+            banks_read_data = new_banks_read_data
+
+        self.comb += [
+            Cat(*[phase.rddata_valid for phase in phases]).eq(banks_read),
+            Cat(*[phase.rddata for phase in phases]).eq(banks_read_data)
+        ]
+
+    def connect_banks(self, phases, banks):
         for nb, bank in enumerate(banks):
             # bank activate
             activates = Signal(len(phases))
@@ -140,15 +173,10 @@ class SDRAMPHYModel(Module):
                 ]
             self.comb += Case(activates, cases)
 
-            # bank precharge
-            precharges = Signal(len(phases))
-            cases = {}
-            for np, phase in enumerate(phases):
-                self.comb += precharges[np].eq(phase.precharge)
-                cases[2**np] = [
-                    bank.precharge.eq((phase.bank == nb) | phase.address[10])
-                ]
-            self.comb += Case(precharges, cases)
+            # bank precharge (several precharges can be issued on the same cycle)
+            precharges = [phase.precharge & ((phase.bank == nb) | phase.address[10])
+                for phase in phases]
+            self.comb += bank.precharge.eq(reduce(or_, precharges))
 
             # bank writes
             writes = Signal(len(phases))
@@ -175,27 +203,3 @@ class SDRAMPHYModel(Module):
                     bank.read_col.eq(phase.address)
             ]
             self.comb += Case(reads, cases)
-
-        # connect banks to DFI phases (cmds, read datapath)
-        banks_read = Signal()
-        banks_read_data = Signal(data_width)
-        self.comb += [
-            banks_read.eq(reduce(or_, [bank.read for bank in banks])),
-            banks_read_data.eq(reduce(or_, [bank.read_data for bank in banks]))
-        ]
-
-        # simulate read latency
-        for i in range(self.settings.read_latency):
-            new_banks_read = Signal()
-            new_banks_read_data = Signal(data_width)
-            self.sync += [
-                new_banks_read.eq(banks_read),
-                new_banks_read_data.eq(banks_read_data)
-            ]
-            banks_read = new_banks_read
-            banks_read_data = new_banks_read_data
-
-        self.comb += [
-            Cat(*[phase.rddata_valid for phase in phases]).eq(banks_read),
-            Cat(*[phase.rddata for phase in phases]).eq(banks_read_data)
-        ]
@@ -320,7 +320,8 @@ def get_sdram_phy_init_sequence(phy_settings, timing_settings):
         mr3 = 0
         mr4 = 0
         mr5 = 0
-        mr6 = format_mr6(4) # FIXME: tCCD
+        tccd = min(max(timing_settings.tCCD*phy_settings.nphases, 4), 8) # tCCD_L
+        mr6 = format_mr6(tccd)
 
         init_sequence = [
             ("Release reset", 0x0000, 0, cmds["UNRESET"], 50000),
@@ -0,0 +1,332 @@
+"""LiteDRAM DFI command trace recorder and analyzer."""
+
+import sys
+import argparse
+from functools import reduce
+from operator import or_
+
+from migen import *
+
+from litex.soc.interconnect.csr import *
+
+
+dfi_commands = {
+    # (ras_n, cas_n, we_n)
+    (0, 1, 1): "ACT",
+    (0, 1, 0): "PRE",
+    (1, 0, 1): "RD",
+    (1, 0, 0): "WR",
+    (0, 0, 1): "REF",
+    (0, 0, 0): "MRS",
+    (1, 1, 0): "ZQC",
+}
+
+
+def dfi_trace_layout(nphases, addressbits, bankbits, nranks, timestamp_bits=32):
+    layout = [("timestamp", timestamp_bits)]
+    for n in range(nphases):
+        layout += [
+            ("p{}_cs_n".format(n),    nranks),
+            ("p{}_ras_n".format(n),   1),
+            ("p{}_cas_n".format(n),   1),
+            ("p{}_we_n".format(n),    1),
+            ("p{}_bank".format(n),    bankbits),
+            ("p{}_address".format(n), addressbits),
+        ]
+    return layout
+
+
+class DFITraceRecorder(Module, AutoCSR):
+    """DFI command trace recorder
+
+    Taps a DFI interface and records the cycles with at least one command
+    (NOPs/deselects are not stored) with their timestamp (sys clk cycles since
+    start) in a memory of depth entries (see dfi_trace_layout).
+
+    A write to start clears the trace and starts the recording, a write to stop
+    ends it. When full, the recording stops, or in ring mode the oldest entries
+    are overwritten (the trace then holds the last commands before stop).
+    Entries are read (oldest first) by writing their index to read_index and
+    reading read_data.
+    """
+    def __init__(self, dfi, depth=512, timestamp_bits=32):
+        phases = dfi.phases
+        layout = dfi_trace_layout(len(phases), len(phases[0].address), len(phases[0].bank),
+            len(phases[0].cs_n), timestamp_bits)
+        width = sum(w for _, w in layout)
+        abits = log2_int(depth)
+
+        self.start = CSR(name="start")
+        self.stop = CSR(name="stop")
+        self.ring = CSRStorage(name="ring")
+        self.recording = CSRStatus(name="recording")
+        self.level = CSRStatus(abits + 1, name="level")
+        self.read_index = CSRStorage(abits, name="read_index")
+        self.read_data = CSRStatus(width, name="read_data")
+
+        # # #
+
+        timestamp = Signal(timestamp_bits)
+        recording = Signal()
+        wrptr = Signal(abits)
+        level = Signal(abits + 1)
+        full = Signal()
+        command = Signal()
+        write = Signal()
+        self.comb += [
+            full.eq(level == depth),
+            command.eq(reduce(or_, [(p.cs_n != 2**len(p.cs_n) - 1) & ~(p.ras_n & p.cas_n & p.we_n)
+                for p in phases])),
+            write.eq(recording & command & (~full | self.ring.storage)),
+            self.recording.status.eq(recording & (~full | self.ring.storage)),
+            self.level.status.eq(level)
+        ]
+        self.sync += [
+            timestamp.eq(timestamp + 1),
+            If(self.start.re,
+                timestamp.eq(0),
+                recording.eq(1),
+                wrptr.eq(0),
+                level.eq(0)
+            ).Elif(self.stop.re,
+                recording.eq(0)
+            ).Elif(write,
+                wrptr.eq(wrptr + 1),
+                If(~full, level.eq(level + 1))
+            )
+        ]
+
+        mem = Memory(width, depth)
+        wrport = mem.get_port(write_capable=True)
+        rdport = mem.get_port()
+        self.specials += mem, wrport, rdport
+        self.comb += [
+            wrport.we.eq(write),
+            wrport.adr.eq(wrptr),
+            wrport.dat_w.eq(Cat(timestamp, *[Cat(p.cs_n, p.ras_n, p.cas_n, p.we_n, p.bank, p.address)
+                for p in phases])),
+            # the oldest entry is overwritten next when full
+            rdport.adr.eq(Mux(full, wrptr, 0) + self.read_index.storage),
+            self.read_data.status.eq(rdport.dat_r)
+        ]
+
+
+def _decode_phase(time, cs_n, ras_n, cas_n, we_n, bank, address, nranks):
+    """Decode the DFI signals of a phase to a (time, cmd, banks, address) command
+    (None for NOPs/deselects), banks being the selected (rank, bank)."""
+    if cs_n == 2**nranks - 1:
+        return None
+    cmd = dfi_commands.get((ras_n, cas_n, we_n), None)
+    if cmd is None:
+        return None
+    ranks = [r for r in range(nranks) if not (cs_n >> r) & 1]
+    return (time, cmd, [(r, bank) for r in ranks], address)
+
+
+def decode_dfi_trace(entries, nphases, addressbits, bankbits, nranks, timestamp_bits=32):
+    """Decode the entries read from a DFITraceRecorder to a list of (time, cmd,
+    banks, address) commands, time in DRAM clk cycles (sys clk cycles*nphases + phase)."""
+    layout = dfi_trace_layout(nphases, addressbits, bankbits, nranks, timestamp_bits)
+    commands = []
+    wraps = 0
+    last = None
+    for entry in entries:
+        fields = {}
+        for name, width in layout:
+            fields[name] = entry & (2**width - 1)
+            entry >>= width
+        # unwrap the timestamps
+        if last is not None and fields["timestamp"] < last:
+            wraps += 1
+        last = fields["timestamp"]
+        cycle = fields["timestamp"] + (wraps << timestamp_bits)
+        for n in range(nphases):
+            command = _decode_phase(cycle*nphases + n,
+                *[fields["p{}_{}".format(n, f)] for f in ["cs_n", "ras_n", "cas_n", "we_n", "bank", "address"]],
+                nranks=nranks)
+            if command is not None:
+                commands.append(command)
+    return commands
+
+
+def read_vcd_dfi_commands(filename, nphases, prefix=None, clk="sys_clk"):
+    """Extract the DFI commands of a simulation VCD (as decode_dfi_trace), time
+    starting at the first clk edge. prefix is the prefix of the DFI signals
+    (<prefix>p0_ras_n, ...), the first DFI interface of the VCD by default."""
+    fields = ["cs_n", "ras_n", "cas_n", "we_n", "bank", "address"]
+    ids = {}
+    widths = {}
+    values = {}
+    commands = []
+    cycle = None
+    clk_id = None
+    with open(filename) as f:
+        lines = iter(f)
+        # header
+        for line in lines:
+            tokens = line.split()
+            if tokens[:1] == ["$var"]:
+                width, vid, name = int(tokens[2]), tokens[3], tokens[4]
+                if name == clk:
+                    clk_id = vid
+                if prefix is None and name.endswith("p0_ras_n"):
+                    prefix = name[:-len("p0_ras_n")]
+                ids.setdefault(name, vid)
+                widths[name] = width
+            elif tokens[:1] in [["$enddefinitions"], ["$dumpvars"]]:
+                break
+        if clk_id is None or prefix is None:
+            raise ValueError("No {} clock or DFI signals in {}".format(clk, filename))
+        phase_ids = [[ids[prefix + "p{}_{}".format(n, f)] for f in fields] for n in range(nphases)]
+        nranks = widths[prefix + "p0_cs_n"]
+
+        # value changes: signals are sampled before each rising edge of clk
+        changes = {}
+        def apply():
+            nonlocal cycle
+            if changes.get(clk_id) == 1 and values.get(clk_id) == 0:
+                cycle = 0 if cycle is None else cycle + 1
+                for n, vids in enumerate(phase_ids):
+                    command = _decode_phase(cycle*nphases + n,
+                        *[values.get(vid, 0) for vid in vids], nranks=nranks)
+                    if command is not None:
+                        commands.append(command)
+            values.update(changes)
+            changes.clear()
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("$"):
+                continue
+            if line[0] == "#":
+                apply()
+            elif line[0] in "bB":
+                value, vid = line[1:].split()
+                changes[vid] = int(value.replace("x", "0").replace("z", "0"), 2)
+            else:
+                changes[line[1:]] = int(line[0]) if line[0] in "01" else 0
+        apply()
+    return commands
+
+
+def analyze_dfi_commands(commands, burst_cycles=1, timings={}):
+    """Analyze (time, cmd, banks, address) DFI commands (time in DRAM clk cycles).
+
+    Returns a report with the number of commands, per (rank, bank) utilization
+    (CAS, activates, row hits/hit rate, fraction of the time with a row open),
+    the data bus efficiency (burst_cycles DRAM clk cycles of data per CAS) and
+    the minimum observed gaps between commands with their slack to the given
+    timings (in DRAM clk cycles)."""
+    report = {"commands": {}, "banks": {}, "gaps": {}, "slacks": {}}
+    if not commands:
+        return report
+    start = commands[0][0]
+    end = commands[-1][0] + 1
+    report["cycles"] = end - start
+
+    opened = {}
+    last = {}
+    def bank_stats(bank):
+        return report["banks"].setdefault(bank, {"activates": 0, "reads": 0, "writes": 0,
+            "row_hits": 0, "open_cycles": 0})
+    def close(bank, now):
+        if opened.get(bank) is not None:
+            bank_stats(bank)["open_cycles"] += now - opened[bank]
+            opened[bank] = None
+    def gap(name, since, now):
+        if since is not None:
+            report["gaps"][name] = min(report["gaps"].get(name, now - since), now - since)
+
+    for now, cmd, banks, address in commands:
+        report["commands"][cmd] = report["commands"].get(cmd, 0) + 1
+        if cmd == "PRE" and address & (1 << 10):
+            banks = [b for b in report["banks"] if b[0] in [r for r, _ in banks]]
+        for bank in banks:
+            stats = bank_stats(bank)
+            if cmd == "ACT":
+                gap("tRP", last.get(("PRE", bank)), now)
+                gap("tRC", last.get(("ACT", bank)), now)
+                gap("tRRD", last.get(("ACT", bank[0])), now)
+                stats["activates"] += 1
+                opened[bank] = now
+                last[("ACT", bank)] = last[("ACT", bank[0])] = now
+                last[("CAS", bank)] = None
+            elif cmd == "PRE":
+                gap("tRAS", last.get(("ACT", bank)), now)
+                close(bank, now)
+                last[("PRE", bank)] = now
+            elif cmd in ["RD", "WR"]:
+                gap("tRCD", last.get(("ACT", bank)), now)
+                gap("tCCD", last.get("CAS"), now)
+                if cmd == "RD":
+                    gap("tWTR", last.get("WR"), now)
+                else:
+                    gap("tRTW", last.get("RD"), now)
+                stats["reads" if cmd == "RD" else "writes"] += 1
+                if last.get(("CAS", bank)) is not None:
+                    stats["row_hits"] += 1
+                last[("CAS", bank)] = last["CAS"] = last[cmd] = now
+                if address & (1 << 10): # auto-precharge
+                    close(bank, now)
+                    last[("PRE", bank)] = now
+    for bank in list(opened):
+        close(bank, end)
+
+    ncas = 0
+    for stats in report["banks"].values():
+        cas = stats["reads"] + stats["writes"]
+        ncas += cas
+        stats["hit_rate"] = stats["row_hits"]/cas if cas else 0
+        stats["open_ratio"] = stats["open_cycles"]/report["cycles"]
+    report["bus_efficiency"] = ncas*burst_cycles/report["cycles"]
+    for name, value in report["gaps"].items():
+        if timings.get(name) is not None:
+            report["slacks"][name] = value - timings[name]
+    return report
+
+
+def print_dfi_report(report, file=sys.stdout):
+    print("Cycles: {}".format(report.get("cycles", 0)), file=file)
+    print("Commands: " + ", ".join("{}: {}".format(c, n) for c, n in sorted(report["commands"].items())), file=file)
+    print("Bus efficiency: {:.1f}%".format(100*report.get("bus_efficiency", 0)), file=file)
+    print("Banks:", file=file)
+    for (rank, bank), stats in sorted(report["banks"].items()):
+        print("  rank{} bank{}: {} RD, {} WR, {} ACT, row hits {:.1f}%, opened {:.1f}%".format(
+            rank, bank, stats["reads"], stats["writes"], stats["activates"],
+            100*stats["hit_rate"], 100*stats["open_ratio"]), file=file)
+    print("Minimum gaps:", file=file)
+    for name, value in sorted(report["gaps"].items()):
+        slack = report["slacks"].get(name)
+        print("  {}: {}{}".format(name, value, "" if slack is None else " (slack: {})".format(slack)), file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiteDRAM DFI command trace analyzer")
+    parser.add_argument("trace", help="VCD file or trace dump (one hex entry per line, oldest first)")
+    parser.add_argument("--nphases", type=int, default=1, help="DFI phases")
+    parser.add_argument("--addressbits", type=int, help="DFI address bits (dump)")
+    parser.add_argument("--bankbits", type=int, help="DFI bank bits (dump)")
+    parser.add_argument("--nranks", type=int, default=1, help="Ranks (dump)")
+    parser.add_argument("--timestamp-bits", type=int, default=32, help="Timestamp bits (dump)")
+    parser.add_argument("--prefix", help="DFI signals prefix (VCD)")
+    parser.add_argument("--burst-cycles", type=int, default=1, help="DRAM clk cycles of data per CAS")
+    parser.add_argument("--timing", action="append", default=[],
+        help="Timing in DRAM clk cycles for the slacks (ex: tRCD=11)")
+    args = parser.parse_args()
+
+    if args.trace.endswith(".vcd"):
+        commands = read_vcd_dfi_commands(args.trace, args.nphases, args.prefix)
+    else:
+        if args.addressbits is None or args.bankbits is None:
+            parser.error("--addressbits and --bankbits are required to decode a dump")
+        with open(args.trace) as f:
+            entries = [int(line, 16) for line in f if line.strip()]
+        commands = decode_dfi_trace(entries, args.nphases, args.addressbits, args.bankbits,
+            args.nranks, args.timestamp_bits)
+    timings = {}
+    for timing in args.timing:
+        name, value = timing.split("=")
+        timings[name] = int(value)
+    print_dfi_report(analyze_dfi_commands(commands, args.burst_cycles, timings))
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from migen import *
 
 from litedram.common import *
 from litedram.frontend.axi import *
+from litedram.frontend.adaptation import LiteDRAMNativePortBurstExpander
 
 from test.common import *
 
@@ -231,3 +232,118 @@ class TestAXI(unittest.TestCase):
         self.assertEqual(self.reads_data_errors, 0)
         self.assertEqual(self.reads_id_errors, 0)
         self.assertEqual(self.reads_last_errors, 0)
+
+    def test_axi2native_burst_commands(self):
+        # INCR bursts of full words are issued in a single command on a port with
+        # a len field (then expanded in single word commands)
+        def writes_generator(axi_port, writes):
+            for write in writes:
+                yield axi_port.aw.valid.eq(1)
+                yield axi_port.aw.addr.eq(write.addr<<2)
+                yield axi_port.aw.burst.eq(write.type)
+                yield axi_port.aw.len.eq(write.len)
+                yield axi_port.aw.size.eq(write.size)
+                yield axi_port.aw.id.eq(write.id)
+                yield
+                while (yield axi_port.aw.ready) == 0:
+                    yield
+                yield axi_port.aw.valid.eq(0)
+
+        def writes_data_generator(axi_port, writes):
+            for write in writes:
+                for i, data in enumerate(write.data):
+                    yield axi_port.w.valid.eq(1)
+                    yield axi_port.w.last.eq(i == len(write.data) - 1)
+                    yield axi_port.w.data.eq(data)
+                    yield axi_port.w.strb.eq(0xf)
+                    yield
+                    while (yield axi_port.w.ready) == 0:
+                        yield
+                    yield axi_port.w.valid.eq(0)
+
+        def writes_response_generator(axi_port, writes, reads):
+            yield axi_port.b.ready.eq(1)
+            for write in writes:
+                while (yield axi_port.b.valid) == 0:
+                    yield
+                if (yield axi_port.b.id) != write.id:
+                    self.errors += 1
+                yield
+            # reads once all the data is written
+            for read in reads:
+                yield axi_port.ar.valid.eq(1)
+                yield axi_port.ar.addr.eq(read.addr<<2)
+                yield axi_port.ar.burst.eq(read.type)
+                yield axi_port.ar.len.eq(read.len)
+                yield axi_port.ar.size.eq(read.size)
+                yield axi_port.ar.id.eq(read.id)
+                yield
+                while (yield axi_port.ar.ready) == 0:
+                    yield
+                yield axi_port.ar.valid.eq(0)
+
+        def reads_response_generator(axi_port, reads):
+            yield axi_port.r.ready.eq(1)
+            yield
+            for read in reads:
+                for i, data in enumerate(read.data):
+                    while (yield axi_port.r.valid) == 0:
+                        yield
+                    if (yield axi_port.r.data) != data:
+                        self.errors += 1
+                    if (yield axi_port.r.id) != read.id:
+                        self.errors += 1
+                    if (yield axi_port.r.last) != (i == len(read.data) - 1):
+                        self.errors += 1
+                    yield
+
+        @passive
+        def commands_counter(port, ncmds):
+            while True:
+                if (yield port.cmd.valid) and (yield port.cmd.ready):
+                    ncmds[(yield port.cmd.we)] += 1
+                yield
+
+        class DUT(Module):
+            def __init__(self):
+                self.axi_port = LiteDRAMAXIPort(32, 32, 8)
+                self.burst_port = LiteDRAMNativePort("both", 32, 32, len_bits=4)
+                self.dram_port = LiteDRAMNativePort("both", 32, 32)
+                self.submodules.axi2native = LiteDRAMAXI2Native(self.axi_port, self.burst_port)
+                self.submodules.expander = LiteDRAMNativePortBurstExpander(
+                    self.burst_port, self.dram_port)
+
+        # INCR bursts (of up to 16 words) are issued in one command, the longer
+        # ones and the FIXED ones beat by beat
+        prng = random.Random(42)
+        bursts = [(0, 0), (1, 3), (8, 15), (24, 7), (32, 19), (64, 0)]
+        writes = []
+        reads = []
+        for addr, length in bursts:
+            data = [prng.randrange(2**32) for _ in range(length + 1)]
+            writes.append(Write(addr, data, prng.randrange(2**8), type=burst_types["incr"],
+                len=length, size=2))
+            reads.append(Read(addr, data, prng.randrange(2**8), type=burst_types["incr"],
+                len=length, size=2))
+        writes.append(Write(80, [prng.randrange(2**32)], 1, type=burst_types["fixed"], len=0, size=2))
+        reads.append(Read(80, writes[-1].data, 2, type=burst_types["fixed"], len=0, size=2))
+
+        self.errors = 0
+        ncmds = {0: 0, 1: 0}
+        dut = DUT()
+        mem = DRAMMemory(32, 128)
+        generators = [
+            writes_generator(dut.axi_port, writes),
+            writes_data_generator(dut.axi_port, writes),
+            writes_response_generator(dut.axi_port, writes, reads),
+            reads_response_generator(dut.axi_port, reads),
+            commands_counter(dut.burst_port, ncmds),
+            mem.read_handler(dut.dram_port),
+            mem.write_handler(dut.dram_port)
+        ]
+        run_simulation(dut, generators)
+        self.assertEqual(self.errors, 0)
+        for write in writes:
+            self.assertEqual(mem.mem[write.addr:write.addr + write.len + 1], write.data)
+        # one command per burst, 20 for the burst of 20 words
+        self.assertEqual(ncmds, {0: 6 + 20, 1: 6 + 20})
@@ -0,0 +1,1011 @@
+import os
+import unittest
+import random
+
+from migen import *
+
+from litedram.common import PhySettings, burst_lengths, get_rtw_latency
+from litedram.modules import SDRAMModule, _TechnologyTimings, _SpeedgradeTimings
+from litedram.core.controller import ControllerSettings, LiteDRAMController
+from litedram.core.multiplexer import tFAWController
+from litedram.core.crossbar import LiteDRAMCrossbar
+from litedram.phy.model import SDRAMPHYModel
+from litedram.trace import DFITraceRecorder, decode_dfi_trace, read_vcd_dfi_commands, analyze_dfi_commands
+
+from litex.gen.sim import *
+from litex.soc.interconnect.csr import CSRStatus
+
+
+class SimModule(SDRAMModule):
+    memtype = "SDR"
+    # geometry
+    nbanks = 4
+    nrows  = 256
+    ncols  = 8
+    # timings
+    technology_timings = _TechnologyTimings(tREFI=64e6/8192, tWTR=(2, None), tCCD=(1, None), tRRD=(2, None))
+    speedgrade_timings = {"default": _SpeedgradeTimings(tRP=20, tRCD=20, tWR=20, tRFC=70, tFAW=(8, None), tRAS=40)}
+
+    def __init__(self, *args, **kwargs):
+        SDRAMModule.__init__(self, *args, **kwargs)
+        # few rows for a small (fast to simulate) memory array, but A10 is still
+        # needed for auto-precharge/precharge all
+        self.geom_settings.addressbits = max(self.geom_settings.addressbits, 11)
+
+
+class SimModuleBankGroups(SimModule):
+    memtype = "DDR4"
+    # geometry
+    nbanks = 2*4 # 2 groups of 4 banks
+    ncols  = 64
+    # timings
+    technology_timings = _TechnologyTimings(tREFI=64e6/8192, tWTR=(3, None), tCCD=(2, None), tRRD=(3, None),
+        tWTR_S=(1, None), tCCD_S=(1, None), tRRD_S=(2, None))
+
+
+def get_sim_phy_settings(nranks=1):
+    return PhySettings(
+        memtype="SDR",
+        dfi_databits=16,
+        nphases=1,
+        rdphase=0,
+        wrphase=0,
+        rdcmdphase=0,
+        wrcmdphase=0,
+        cl=2,
+        read_latency=4,
+        write_latency=0,
+        nranks=nranks
+    )
+
+
+def get_sim_phy_settings_1_4(nranks=1, memtype="DDR3"):
+    # DDR3-800 on a 1:4 PHY (S7DDRPHY @ 100MHz)
+    return PhySettings(
+        memtype=memtype,
+        dfi_databits=16,
+        nphases=4,
+        rdphase=2,
+        wrphase=3,
+        rdcmdphase=1,
+        wrcmdphase=2,
+        cl=6,
+        cwl=5,
+        read_latency=8,
+        write_latency=0,
+        nranks=nranks
+    )
+
+
+class ControllerDUT(Module):
+    def __init__(self, controller_settings, nports=1, timings={}, nranks=1, phy_settings=None,
+                 module_cls=SimModule):
+        module = module_cls(100e6, "1:1")
+        module.timing_settings.set_attributes(timings)
+        if phy_settings is None:
+            phy_settings = get_sim_phy_settings(nranks)
+        self.submodules.phy = SDRAMPHYModel(module, phy_settings)
+        self.submodules.controller = LiteDRAMController(
+            phy_settings, module.geom_settings, module.timing_settings, controller_settings)
+        self.comb += self.controller.dfi.connect(self.phy.dfi)
+        self.submodules.crossbar = LiteDRAMCrossbar(self.controller.interface)
+        self.ports = [self.crossbar.get_port() for i in range(nports)]
+        self.checker = DFITimingChecker(self.controller.dfi, module.nbanks,
+            phy_settings, module.timing_settings)
+
+
+class DFITimingChecker:
+    """Monitors DFI commands and records DRAM protocol and timing violations."""
+    def __init__(self, dfi, nbanks, phy_settings, timing_settings):
+        self.dfi = dfi
+        self.nbanks = nbanks
+        self.nphases = phy_settings.nphases
+        self.phy_settings = phy_settings
+        self.timing_settings = timing_settings
+        self.violations = []
+        self.commands = []
+
+    def ck(self, t):
+        # timings are expressed in sys clk cycles, allow commands on any phase
+        return 0 if t is None else t*self.nphases - (self.nphases - 1)
+
+    def check(self, now, since, timing, name):
+        if since is not None and now - since < self.ck(timing):
+            self.violations.append((now, name))
+
+    def bank_group(self, bank):
+        # DDR4: 4 banks per bank group
+        if self.phy_settings.memtype == "DDR4" and self.timing_settings.tCCD_S is not None:
+            return bank[1]//4
+        return 0
+
+    @passive
+    def generator(self):
+        t = self.timing_settings
+        write_latency = -(-self.phy_settings.cwl//self.nphases)
+        twtp = write_latency + t.tWR + (t.tCCD or 0)
+        twtr = t.tWTR + write_latency + (t.tCCD or 0)
+        # different bank groups timings
+        tccd_s = t.tCCD if t.tCCD_S is None else t.tCCD_S
+        trrd_s = t.tRRD if t.tRRD_S is None else t.tRRD_S
+        twtr_s = twtr if t.tWTR_S is None else t.tWTR_S + write_latency + (t.tCCD or 0)
+        # read data must be off the bus before write data: CL + BL/2 + 2 - CWL
+        # (SDR: write data with the command, one turnaround cycle)
+        if self.phy_settings.memtype == "SDR":
+            trtw = self.phy_settings.cl + 2
+        else:
+            trtw = self.phy_settings.cl + burst_lengths[self.phy_settings.memtype]//2 + 2 - self.phy_settings.cwl
+        opened = {}
+        last_act = {}
+        last_pre = {}
+        last_write = {}
+        last_act_any = None
+        last_act_group = {}
+        acts = []
+        last_cas = None
+        last_cas_group = {}
+        last_write_any = None
+        last_write_group = {}
+        last_read_any = None
+        last_ref = {}
+        cycle = 0
+        while True:
+            for n, phase in enumerate(self.dfi.phases):
+                now = cycle*self.nphases + n
+                cs_n = (yield phase.cs_n)
+                if cs_n == 2**len(phase.cs_n) - 1:
+                    continue
+                ras_n, cas_n, we_n = (yield phase.ras_n), (yield phase.cas_n), (yield phase.we_n)
+                cmd = {
+                    (0, 1, 1): "ACT",
+                    (0, 1, 0): "PRE",
+                    (1, 0, 1): "RD",
+                    (1, 0, 0): "WR",
+                    (0, 0, 1): "REF"}.get((ras_n, cas_n, we_n), None)
+                if cmd is None:
+                    continue
+                ranks = [r for r in range(len(phase.cs_n)) if not (cs_n >> r) & 1]
+                bank = (yield phase.bank)
+                banks = [(r, bank) for r in ranks]
+                address = (yield phase.address)
+                self.commands.append((now, cmd, banks, address))
+                if cmd == "REF":
+                    for r in ranks:
+                        for b in range(self.nbanks):
+                            if opened.get((r, b), None) is not None:
+                                self.violations.append((now, "REF with opened bank"))
+                            self.check(now, last_pre.get((r, b)), t.tRP, "tRP")
+                        last_ref[r] = now
+                    continue
+                if cmd == "PRE" and address & (1 << 10):
+                    banks = [(r, b) for r in ranks for b in range(self.nbanks)]
+                for bank in banks:
+                    group = self.bank_group(bank)
+                    if cmd == "ACT":
+                        if opened.get(bank, None) is not None:
+                            self.violations.append((now, "ACT to opened bank"))
+                        self.check(now, last_pre.get(bank), t.tRP, "tRP")
+                        self.check(now, last_act.get(bank), t.tRC, "tRC")
+                        self.check(now, last_act_any, trrd_s, "tRRD")
+                        self.check(now, last_act_group.get(group), t.tRRD, "tRRD")
+                        self.check(now, last_ref.get(bank[0]), t.tRFC, "tRFC")
+                        if t.tFAW is not None:
+                            acts = [a for a in acts if now - a < self.ck(t.tFAW)]
+                            if len(acts) >= 4:
+                                self.violations.append((now, "tFAW"))
+                            acts.append(now)
+                        opened[bank] = address
+                        last_act[bank] = now
+                        last_act_any = now
+                        last_act_group[group] = now
+                    elif cmd == "PRE":
+                        if opened.get(bank, None) is not None:
+                            self.check(now, last_act.get(bank), t.tRAS, "tRAS")
+                            self.check(now, last_write.get(bank), twtp, "tWTP")
+                            opened[bank] = None
+                            last_pre[bank] = now
+                    else:
+                        if opened.get(bank, None) is None:
+                            self.violations.append((now, cmd + " to closed bank"))
+                        self.check(now, last_act.get(bank), t.tRCD, "tRCD")
+                        self.check(now, last_cas, tccd_s, "tCCD")
+                        self.check(now, last_cas_group.get(group), t.tCCD, "tCCD")
+                        if cmd == "RD":
+                            self.check(now, last_write_any, twtr_s, "tWTR")
+                            self.check(now, last_write_group.get(group), twtr, "tWTR")
+                            last_read_any = now
+                        if cmd == "WR" and last_read_any is not None:
+                            if now - last_read_any < trtw:
+                                self.violations.append((now, "tRTW"))
+                        last_cas = now
+                        last_cas_group[group] = now
+                        if cmd == "WR":
+                            last_write[bank] = now
+                            last_write_any = now
+                            last_write_group[group] = now
+                        if address & (1 << 10):
+                            # auto-precharge: precharge once tRAS/tWTP are met
+                            pre = now
+                            if cmd == "WR":
+                                pre = now + self.ck(twtp)
+                            if t.tRAS is not None:
+                                pre = max(pre, last_act[bank] + self.ck(t.tRAS))
+                            opened[bank] = None
+                            last_pre[bank] = pre
+            cycle += 1
+            yield
+
+
+class PortDriver:
+    """Issues a sequence of (we, addr, data) accesses on a native port and
+    checks read data against the expected memory content. With dependent,
+    a read is only issued once the data of the previous read is received."""
+    def __init__(self, port, accesses, memory=None, dependent=False):
+        self.port = port
+        self.accesses = accesses
+        self.memory = {} if memory is None else memory
+        self.dependent = dependent
+        self.errors = 0
+        self.nrdatas = 0
+        self.done = False
+
+        self.wdatas = []
+        self.rdatas = []
+        for we, addr, data in accesses:
+            if we:
+                self.memory[addr] = data
+                self.wdatas.append(data)
+            else:
+                self.rdatas.append(self.memory.get(addr, 0))
+
+    def cmd_generator(self):
+        port = self.port
+        nreads = 0
+        for we, addr, data in self.accesses:
+            if self.dependent and self.nrdatas < nreads:
+                yield port.cmd.valid.eq(0)
+                while self.nrdatas < nreads:
+                    yield
+            yield port.cmd.valid.eq(1)
+            yield port.cmd.we.eq(we)
+            yield port.cmd.addr.eq(addr)
+            yield
+            while (yield port.cmd.ready) == 0:
+                yield
+            nreads += not we
+        yield port.cmd.valid.eq(0)
+
+    def wdata_generator(self):
+        port = self.port
+        yield port.wdata.we.eq(2**len(port.wdata.we) - 1)
+        for data in self.wdatas:
+            yield port.wdata.valid.eq(1)
+            yield port.wdata.data.eq(data)
+            yield
+            while (yield port.wdata.ready) == 0:
+                yield
+        yield port.wdata.valid.eq(0)
+
+    def rdata_generator(self):
+        port = self.port
+        yield port.rdata.ready.eq(1)
+        for data in self.rdatas:
+            yield
+            while (yield port.rdata.valid) == 0:
+                yield
+            if (yield port.rdata.data) != data:
+                self.errors += 1
+            self.nrdatas += 1
+        self.done = True
+
+    def generators(self):
+        return [self.cmd_generator(), self.wdata_generator(), self.rdata_generator()]
+
+
+def run_accesses(controller_settings, accesses_per_port, timings={}, dut_callback=None, nranks=1,
+                 phy_settings=None, module_cls=SimModule, dependent=False):
+    dut = ControllerDUT(controller_settings, len(accesses_per_port), timings, nranks, phy_settings,
+        module_cls)
+    drivers = [PortDriver(port, accesses, dependent=dependent)
+        for port, accesses in zip(dut.ports, accesses_per_port)]
+    cycles = [0]
+
+    def timer():
+        while not all(driver.done for driver in drivers):
+            cycles[0] += 1
+            yield
+
+    generators = [timer(), dut.checker.generator()]
+    for driver in drivers:
+        generators += driver.generators()
+    run_simulation(dut, generators)
+    if dut_callback is not None:
+        dut_callback(dut)
+    errors = sum(driver.errors for driver in drivers) + len(dut.checker.violations)
+    return errors, cycles[0]
+
+
+def random_accesses(naccesses, address_range, seed=42, address_base=0):
+    prng = random.Random(seed)
+    accesses = []
+    for i in range(naccesses):
+        we = prng.randrange(2)
+        addr = address_base + prng.randrange(address_range)
+        accesses.append((we, addr, prng.randrange(2**16)))
+    # read back everything at the end
+    for addr in sorted(set(a for _, a, _ in accesses)):
+        accesses.append((0, addr, 0))
+    return accesses
+
+
+class TestController(unittest.TestCase):
+    def test_fcfs(self):
+        errors, cycles = run_accesses(ControllerSettings(), [random_accesses(32, 2**11)])
+        self.assertEqual(errors, 0)
+
+    def test_frfcfs(self):
+        settings = ControllerSettings(cmd_buffer_depth=4, with_frfcfs=True, frfcfs_max_age=4)
+        # younger row hits must not bypass older accesses to the same address
+        accesses = []
+        for i in range(4):
+            accesses += [
+                (0, (1 << 5) | i,     0),
+                (1, (2 << 5) | i,     2*i),
+                (1, (1 << 5) | i,     2*i + 1),
+                (0, (1 << 5) | i,     0),
+            ]
+        errors, cycles = run_accesses(settings, [accesses + random_accesses(32, 2**7)])
+        self.assertEqual(errors, 0)
+
+    def test_frfcfs_row_hits_first(self):
+        # writes to a row interleaved with reads from another row of the same bank
+        accesses = []
+        for i in range(16):
+            accesses.append((1, (1 << 5) | (i%8), i))
+            accesses.append((0, (2 << 5) | (i%8), 0))
+        errors, fcfs_cycles = run_accesses(ControllerSettings(), [accesses])
+        self.assertEqual(errors, 0)
+        errors, frfcfs_cycles = run_accesses(ControllerSettings(with_frfcfs=True), [accesses])
+        self.assertEqual(errors, 0)
+        self.assertLess(frfcfs_cycles, fcfs_cycles)
+
+    def test_page_policies(self):
+        def auto_precharges(dut):
+            a10s.append([(c[3] >> 10) & 1 for c in dut.checker.commands if c[1] in ["RD", "WR"]])
+
+        for page_policy in ["close", "adaptive"]:
+            settings = ControllerSettings(page_policy=page_policy)
+            errors, cycles = run_accesses(settings, [random_accesses(32, 2**7)])
+            self.assertEqual(errors, 0)
+
+        # latency bound reads (empty bank queues after each read): the adaptive
+        # predictor closes rows on random rows and keeps them opened on a same row
+        prng = random.Random(42)
+        random_reads = [(0, prng.randrange(2**11), 0) for i in range(24)]
+        same_row_reads = [(0, (1 << 5) | (i%8), 0) for i in range(24)]
+        a10s = []
+        cycles = {}
+        for page_policy, reads in [("open", random_reads), ("adaptive", random_reads), ("adaptive", same_row_reads)]:
+            errors, cycles[page_policy, reads is random_reads] = run_accesses(
+                ControllerSettings(page_policy=page_policy), [reads],
+                dut_callback=auto_precharges, dependent=True)
+            self.assertEqual(errors, 0)
+        self.assertEqual(sum(a10s[0]), 0)
+        self.assertGreater(sum(a10s[1]), len(a10s[1])//2)
+        self.assertEqual(sum(a10s[2][4:]), 0)
+        self.assertLess(cycles["adaptive", True], cycles["open", True])
+
+    def test_refresh_postponing(self):
+        def refreshes(dut):
+            return [c[0] for c in dut.checker.commands if c[1] == "REF"]
+
+        accesses = [random_accesses(32, 2**7)]
+        timings = {"tREFI": 64}
+        refs = {}
+        cycles = {}
+        for postponing in [0, 4]:
+            settings = ControllerSettings(refresh_postponing=postponing)
+            errors, cycles[postponing] = run_accesses(settings, accesses, timings,
+                lambda dut: refs.__setitem__(postponing, refreshes(dut)))
+            self.assertEqual(errors, 0)
+        # refreshes are postponed while there is pending traffic
+        self.assertLess(cycles[4], cycles[0])
+        self.assertEqual([r for r in refs[4] if 64 < r < 4*64], [])
+        # but never more than 4 of them
+        self.assertGreaterEqual(len(refs[4]), cycles[4]//65 - 4)
+
+    def test_refresh_per_rank(self):
+        commands = []
+        accesses = [random_accesses(32, 2**8)]
+        settings = ControllerSettings(refresh_mode="rank")
+        errors, cycles = run_accesses(settings, accesses, {"tREFI": 64},
+            lambda dut: commands.extend(dut.checker.commands), nranks=2)
+        self.assertEqual(errors, 0)
+        # ranks are refreshed in turn, one at a time
+        refs = [c for c in commands if c[1] == "REF"]
+        self.assertGreater(len(refs), 2)
+        for i, (now, cmd, banks, address) in enumerate(refs):
+            self.assertEqual([r for r, b in banks], [i%2])
+        # the other rank is accessed during tRFC
+        trfc = 7
+        self.assertTrue(any(c[1] in ["ACT", "RD", "WR"] and
+            any(ref[0] < c[0] < ref[0] + trfc and c[2][0][0] != ref[2][0][0] for ref in refs)
+            for c in commands))
+
+    def test_refresh_opportunistic(self):
+        def refreshes(settings, ncycles=256):
+            dut = ControllerDUT(settings, timings={"tREFI": 64})
+            counts = {"early": 0, "forced": 0}
+            def monitor():
+                for i in range(ncycles):
+                    for name in counts.keys():
+                        counts[name] += (yield getattr(dut.controller.refresher, name))
+                    yield
+            run_simulation(dut, [monitor(), dut.checker.generator()])
+            self.assertEqual(dut.checker.violations, [])
+            return counts
+
+        # idle controller: refreshes are started early when a window is set
+        counts = refreshes(ControllerSettings())
+        self.assertEqual(counts["early"], 0)
+        self.assertGreater(counts["forced"], 0)
+        counts = refreshes(ControllerSettings(refresh_window=32))
+        self.assertGreater(counts["early"], 0)
+        self.assertEqual(counts["forced"], 0)
+
+        settings = ControllerSettings(refresh_window=32, refresh_idle_threshold=2)
+        errors, cycles = run_accesses(settings, [random_accesses(32, 2**7)], {"tREFI": 64})
+        self.assertEqual(errors, 0)
+
+    def test_write_watermarks(self):
+        def turnarounds(dut):
+            cmds = [c[1] for c in dut.checker.commands if c[1] in ["RD", "WR"]]
+            counts.append(sum(a != b for a, b in zip(cmds[:-1], cmds[1:])))
+
+        # two writing ports and two reading ports on different banks
+        prng = random.Random(42)
+        accesses = []
+        for i in range(4):
+            accesses.append([(i < 2, (prng.randrange(4) << 5) | (i << 3) | prng.randrange(8),
+                prng.randrange(2**16)) for j in range(16)])
+        counts = []
+        for settings in [ControllerSettings(),
+                         ControllerSettings(write_high_watermark=8, write_low_watermark=1)]:
+            errors, cycles = run_accesses(settings, accesses, dut_callback=turnarounds)
+            self.assertEqual(errors, 0)
+        self.assertLess(counts[1], counts[0]//2)
+
+        # one port, mixed reads/writes on one bank: queued reads/writes that can't
+        # be issued (behind the other type in the bank) must not hold the drain
+        accesses = [[(prng.randrange(2), (prng.randrange(4) << 5) | prng.randrange(8),
+            prng.randrange(2**16)) for j in range(32)]]
+        cycles = {}
+        for high, low in [(0, 0), (8, 1)]:
+            settings = ControllerSettings(write_high_watermark=high, write_low_watermark=low)
+            errors, cycles[high] = run_accesses(settings, accesses)
+            self.assertEqual(errors, 0)
+        self.assertLessEqual(cycles[8], cycles[0])
+
+    def test_rtw_latency(self):
+        # SDR: no turnaround reduction
+        self.assertEqual(get_rtw_latency(get_sim_phy_settings()), 4)
+        # DDR3-800 on a 1:4 PHY: CL=6, CWL=5
+        self.assertEqual(get_rtw_latency(get_sim_phy_settings_1_4()), 3)
+
+        # RD to WR spacing is checked by the DFITimingChecker
+        accesses = [[(i%2, (i%4) << 3, i) for i in range(32)]]
+        errors, cycles = run_accesses(ControllerSettings(read_time=2, write_time=2), accesses)
+        self.assertEqual(errors, 0)
+
+    def test_crossbar_ordering(self):
+        # row misses spread over the banks: the commands of the port are in several
+        # banks at once (faster than on a single bank), data has to be returned in order
+        def row_misses(nbanks):
+            addrs = [((16 + i//nbanks) << 5) | ((i%nbanks) << 3) | (i%8) for i in range(16)]
+            return [(1, addr, i) for i, addr in enumerate(addrs)] + [(0, addr, 0) for addr in addrs]
+        errors, single_bank_cycles = run_accesses(ControllerSettings(), [row_misses(1)])
+        self.assertEqual(errors, 0)
+        for with_frfcfs in [False, True]:
+            errors, cycles = run_accesses(ControllerSettings(with_frfcfs=with_frfcfs), [row_misses(4)])
+            self.assertEqual(errors, 0)
+            self.assertLess(cycles, single_bank_cycles)
+
+        # mixed reads/writes over the banks with FR-FCFS reordering in the banks
+        errors, cycles = run_accesses(ControllerSettings(with_frfcfs=True),
+            [random_accesses(48, 2**9, seed=1)])
+        self.assertEqual(errors, 0)
+
+    def test_read_reorder(self):
+        def run(settings, accesses, **kwargs):
+            dut = ControllerDUT(settings, nports=0)
+            dut.ports = [dut.crossbar.get_port(**kwargs)]
+            driver = PortDriver(dut.ports[0], accesses)
+            cycles = [0]
+            def timer():
+                while not driver.done:
+                    cycles[0] += 1
+                    yield
+            run_simulation(dut, [timer(), dut.checker.generator()] + driver.generators())
+            self.assertEqual(driver.errors, 0)
+            self.assertEqual(dut.checker.violations, [])
+            return cycles[0]
+
+        # row misses on bank 0 interleaved with row hits on bank 1
+        reads = []
+        for i in range(8):
+            reads += [(0, (16 + i) << 5, 0), (0, (1 << 3) | i, 0)]
+        cycles = {depth: run(ControllerSettings(), reads, reorder_depth=depth) for depth in [0, 8]}
+        self.assertLess(cycles[8], cycles[0])
+
+        # data integrity, also with FR-FCFS
+        for with_frfcfs in [False, True]:
+            run(ControllerSettings(with_frfcfs=with_frfcfs), random_accesses(32, 2**9), reorder_depth=4)
+
+    def test_posted_writes(self):
+        def run(settings, accesses, **kwargs):
+            dut = ControllerDUT(settings, nports=0)
+            dut.ports = [dut.crossbar.get_port(**kwargs)]
+            port = dut.ports[0]
+            driver = PortDriver(port, accesses)
+            wdata_cycles = [0]
+            def wdata_timer():
+                nwdatas = 0
+                while nwdatas < len(driver.wdatas):
+                    nwdatas += (yield port.wdata.valid) & (yield port.wdata.ready)
+                    wdata_cycles[0] += 1
+                    yield
+            run_simulation(dut, [wdata_timer(), dut.checker.generator()] + driver.generators())
+            self.assertEqual(driver.errors, 0)
+            self.assertEqual(dut.checker.violations, [])
+            return wdata_cycles[0]
+
+        # write data accepted before the writes are issued
+        writes = []
+        for i in range(8):
+            writes += [(1, (16 + i) << 5, i), (1, (1 << 3) | i, 8 + i)]
+        writes += [(0, addr, 0) for _, addr, _ in writes]
+        cycles = {depth: run(ControllerSettings(), writes, write_buffer_depth=depth) for depth in [0, 16]}
+        self.assertLess(cycles[16], cycles[0]//2)
+
+        # data integrity, also with FR-FCFS and a read reorder buffer
+        run(ControllerSettings(), random_accesses(32, 2**9), write_buffer_depth=4)
+        run(ControllerSettings(with_frfcfs=True), random_accesses(32, 2**9),
+            write_buffer_depth=4, reorder_depth=4)
+
+    def test_write_forwarding(self):
+        def run(settings, accesses, **kwargs):
+            dut = ControllerDUT(settings, nports=0)
+            dut.ports = [dut.crossbar.get_port(write_buffer_depth=4, **kwargs)]
+            driver = PortDriver(dut.ports[0], accesses)
+            run_simulation(dut, [dut.checker.generator()] + driver.generators())
+            self.assertEqual(driver.errors, 0)
+            self.assertEqual(dut.checker.violations, [])
+            cmds = [c[1] for c in dut.checker.commands]
+            return cmds.count("WR"), cmds.count("RD")
+
+        # spill/reload: back-to-back writes to an address then a read of it
+        accesses = []
+        for i in range(8):
+            addr = (i << 3) | i
+            accesses += [(1, addr, i), (1, addr, 16 + i), (0, addr, 0)]
+        self.assertEqual(run(ControllerSettings(), accesses), (16, 8))
+        # writes merged
+        self.assertEqual(run(ControllerSettings(), accesses, write_forwarding=True), (8, 8))
+        # reads served from the write data buffer
+        nwrites, nreads = run(ControllerSettings(), accesses, write_forwarding=True, reorder_depth=4)
+        self.assertEqual(nreads, 0)
+
+        # data integrity, also with FR-FCFS
+        for with_frfcfs in [False, True]:
+            run(ControllerSettings(with_frfcfs=with_frfcfs), random_accesses(32, 2**4),
+                write_forwarding=True, reorder_depth=4)
+
+    def test_bank_xor_mapping(self):
+        def banks(dut):
+            activated.append(set(c[2][0] for c in dut.checker.commands if c[1] == "ACT"))
+
+        # power of two strides: one and two rows (same bank with ROW_BANK_COL)
+        for stride in [1 << 5, 2 << 5]:
+            addrs = [i*stride for i in range(16)]
+            accesses = [(1, addr, i) for i, addr in enumerate(addrs)] + [(0, addr, 0) for addr in addrs]
+            activated = []
+            cycles = {}
+            for address_mapping in ["ROW_BANK_COL", "ROW_BANK_COL_XOR"]:
+                settings = ControllerSettings(address_mapping=address_mapping)
+                errors, cycles[address_mapping] = run_accesses(settings, [accesses], dut_callback=banks)
+                self.assertEqual(errors, 0)
+            self.assertEqual(len(activated[0]), 1)
+            self.assertGreater(len(activated[1]), 1)
+            self.assertLess(cycles["ROW_BANK_COL_XOR"], cycles["ROW_BANK_COL"])
+
+    def test_multi_cmd(self):
+        # random accesses (row conflicts): precharges issued on the free phases
+        accesses = [random_accesses(32, 2**9, seed=i, address_base=i << 9) for i in range(2)]
+        cycles = {}
+        for with_multi_cmd in [False, True]:
+            settings = ControllerSettings(with_multi_cmd=with_multi_cmd)
+            errors, cycles[with_multi_cmd] = run_accesses(settings, accesses,
+                phy_settings=get_sim_phy_settings_1_4())
+            self.assertEqual(errors, 0)
+        self.assertLess(cycles[True], cycles[False])
+
+    def test_bank_groups(self):
+        # one port streaming on each bank group (banks 0 and 4)
+        accesses = []
+        for bank in [0, 4]:
+            addrs = [((i//8) << 6) | (bank << 3) | (i%8) for i in range(8)]
+            accesses.append([(1, addr, i) for i, addr in enumerate(addrs)] + [(0, addr, 0) for addr in addrs])
+        cycles = {}
+        for short_timings in [False, True]:
+            timings = {} if short_timings else {"tCCD_S": None, "tRRD_S": None, "tWTR_S": None}
+            errors, cycles[short_timings] = run_accesses(ControllerSettings(), accesses, timings,
+                phy_settings=get_sim_phy_settings_1_4(memtype="DDR4"), module_cls=SimModuleBankGroups)
+            self.assertEqual(errors, 0)
+        self.assertLess(cycles[True], cycles[False])
+
+    def test_crossbar_qos(self):
+        def run(ports_kwargs, accesses):
+            dut = ControllerDUT(ControllerSettings(), nports=0)
+            dut.ports = [dut.crossbar.get_port(**kwargs) for kwargs in ports_kwargs]
+            drivers = [PortDriver(port, a) for port, a in zip(dut.ports, accesses)]
+            done = [None]*len(drivers)
+            def timer():
+                cycle = 0
+                while None in done:
+                    for i, driver in enumerate(drivers):
+                        if driver.done and done[i] is None:
+                            done[i] = cycle
+                    cycle += 1
+                    yield
+            generators = [timer(), dut.checker.generator()]
+            for driver in drivers:
+                generators += driver.generators()
+            run_simulation(dut, generators)
+            self.assertEqual(sum(driver.errors for driver in drivers), 0)
+            self.assertEqual(dut.checker.violations, [])
+            return done
+
+        # bulk port streaming on bank 0, latency critical port accessing the same bank
+        bulk = [(1, ((i//8) << 5) | (i%8), i) for i in range(64)]
+        cpu = [(0, (64 + i) << 5, 0) for i in range(8)]
+        alone = run([{}], [cpu])[0]
+        done = run([{}, {}], [bulk, cpu])[1]
+        done_qos = run([{"weight": 4}, {"priority": 1}], [bulk, cpu])[1]
+        self.assertLess(done_qos - alone, (done - alone)//4)
+
+        # bandwidth limit: 1 command every 8 cycles
+        hits = [(0, i%8, 0) for i in range(16)]
+        self.assertLess(run([{}], [hits])[0], 8*15)
+        self.assertGreaterEqual(run([{"bandwidth": (1, 8)}], [hits])[0], 8*15)
+
+    def test_runtime_csrs(self):
+        def run(settings, runtime={}):
+            dut = ControllerDUT(settings)
+            driver = PortDriver(dut.ports[0], random_accesses(32, 2**9))
+            def configure():
+                for name, value in runtime.items():
+                    yield getattr(dut.controller, name).storage.eq(value)
+            run_simulation(dut, [configure(), dut.checker.generator()] + driver.generators())
+            self.assertEqual(driver.errors, 0)
+            self.assertEqual(dut.checker.violations, [])
+            return dut.checker.commands
+
+        def act_to_cas(commands):
+            acts = {}
+            delays = []
+            for now, cmd, banks, address in commands:
+                for bank in banks:
+                    if cmd == "ACT":
+                        acts[bank] = now
+                    elif cmd in ["RD", "WR"]:
+                        delays.append(now - acts[bank])
+            return delays
+
+        def a10s(commands):
+            return [(address >> 10) & 1 for now, cmd, banks, address in commands if cmd in ["RD", "WR"]]
+
+        # reset values: same commands as without runtime CSRs
+        commands = run(ControllerSettings())
+        self.assertEqual(run(ControllerSettings(with_runtime_csrs=True)), commands)
+        self.assertLess(min(act_to_cas(commands)), 6)
+        self.assertGreater(sum(a10s(commands)), 0)
+
+        # timings and auto-precharge changed at runtime
+        commands = run(ControllerSettings(with_runtime_csrs=True), {"trcd": 6, "with_auto_precharge": 0})
+        self.assertGreaterEqual(min(act_to_cas(commands)), 6)
+        self.assertEqual(sum(a10s(commands)), 0)
+
+    def test_perfmon(self):
+        dut = ControllerDUT(ControllerSettings(with_perfmon=True))
+        driver = PortDriver(dut.ports[0], random_accesses(64, 2**11))
+        counters = {}
+        def snapshot():
+            # crossbar counters are created when finalized
+            perfmons = [dut.controller.multiplexer.perfmon, dut.crossbar.perfmon]
+            while not driver.done:
+                yield
+            for perfmon in perfmons:
+                yield perfmon.snapshot.re.eq(1)
+            yield
+            for perfmon in perfmons:
+                yield perfmon.snapshot.re.eq(0)
+            yield
+            for perfmon in perfmons:
+                for csr in perfmon.get_csrs():
+                    if isinstance(csr, CSRStatus):
+                        counters[csr.name] = (yield csr.status)
+        run_simulation(dut, [snapshot(), dut.checker.generator()] + driver.generators())
+        self.assertEqual(driver.errors, 0)
+        self.assertEqual(dut.checker.violations, [])
+
+        # command counts match the DFI commands
+        commands = dut.checker.commands
+        def count(cmd, bank=None, a10=None):
+            return len([c for _, c, banks, address in commands if c in cmd and
+                (bank is None or banks == [(0, bank)]) and
+                (a10 is None or ((address >> 10) & 1) == a10)])
+        self.assertEqual(counters["activates"], count(["ACT"]))
+        self.assertEqual(counters["precharges"], count(["PRE"]))
+        for n in range(4):
+            self.assertEqual(counters["bank{}_row_hits".format(n)],
+                count(["RD", "WR"], n) - count(["ACT"], n))
+            self.assertEqual(counters["bank{}_row_conflicts".format(n)], count(["PRE"], n, a10=0))
+            self.assertEqual(counters["bank{}_row_misses".format(n)] + counters["bank{}_row_conflicts".format(n)],
+                count(["ACT"], n))
+
+        # turnarounds: at least one per change of command type
+        cas = [c for _, c, _, _ in commands if c in ["RD", "WR"]]
+        self.assertGreaterEqual(counters["read_to_write_turnarounds"],
+            len([1 for a, b in zip(cas, cas[1:]) if (a, b) == ("RD", "WR")]))
+        self.assertGreaterEqual(counters["write_to_read_turnarounds"],
+            len([1 for a, b in zip(cas, cas[1:]) if (a, b) == ("WR", "RD")]))
+        self.assertGreater(counters["trrd_stall_cycles"], 0)
+        self.assertEqual(counters["tccd_stall_cycles"], 0) # tCCD=1
+
+        # port requests
+        self.assertEqual(counters["port0_reads"], len([a for a in driver.accesses if not a[0]]))
+        self.assertEqual(counters["port0_writes"], len([a for a in driver.accesses if a[0]]))
+
+    def test_dfi_trace(self):
+        def run(depth, ring, vcd_name=None):
+            dut = ControllerDUT(ControllerSettings())
+            dut.submodules.recorder = recorder = DFITraceRecorder(dut.controller.dfi, depth=depth)
+            driver = PortDriver(dut.ports[0], random_accesses(32, 2**11))
+            entries = []
+            def read_trace():
+                yield recorder.ring.storage.eq(ring)
+                yield recorder.start.re.eq(1)
+                yield
+                yield recorder.start.re.eq(0)
+                while not driver.done:
+                    yield
+                yield recorder.stop.re.eq(1)
+                yield
+                yield recorder.stop.re.eq(0)
+                yield
+                for i in range((yield recorder.level.status)):
+                    yield recorder.read_index.storage.eq(i)
+                    yield
+                    yield
+                    entries.append((yield recorder.read_data.status))
+            run_simulation(dut, [read_trace(), dut.checker.generator()] + driver.generators(),
+                vcd_name=vcd_name)
+            self.assertEqual(driver.errors, 0)
+            commands = decode_dfi_trace(entries, 1, 11, 2, 1)
+            return commands, dut.checker.commands
+
+        def relative(commands):
+            return [(now - commands[0][0], cmd, banks, address) for now, cmd, banks, address in commands]
+
+        # all the commands recorded, timestamps relative to the first one
+        commands, reference = run(depth=512, ring=0, vcd_name="test_dfi_trace.vcd")
+        self.assertEqual(relative(commands), relative(reference))
+
+        # same commands extracted from a simulation VCD
+        self.assertEqual(relative(read_vcd_dfi_commands("test_dfi_trace.vcd", 1)), relative(reference))
+        os.remove("test_dfi_trace.vcd")
+
+        # timings respected (positive slacks) and statistics consistent with the commands
+        timings = {t: getattr(SimModule(100e6, "1:1").timing_settings, t)
+            for t in ["tRP", "tRCD", "tRRD", "tRAS", "tRC"]}
+        report = analyze_dfi_commands(reference, timings=timings)
+        self.assertEqual(sorted(report["slacks"]), sorted(timings))
+        self.assertTrue(all(slack >= 0 for slack in report["slacks"].values()))
+        ncas = len([c for _, c, _, _ in reference if c in ["RD", "WR"]])
+        nacts = len([c for _, c, _, _ in reference if c == "ACT"])
+        self.assertEqual(sum(b["row_hits"] for b in report["banks"].values()), ncas - nacts)
+        self.assertAlmostEqual(report["bus_efficiency"], ncas/report["cycles"])
+
+        # one-shot (first commands) and ring (last commands) modes
+        commands, reference = run(depth=16, ring=0)
+        self.assertEqual(relative(commands), relative(reference[:16]))
+        commands, reference = run(depth=16, ring=1)
+        self.assertEqual(relative(commands), relative(reference[-16:]))
+
+    def test_tfaw_incremental(self):
+        # same ready as the adder tree implementation, with activates respecting
+        # ready (as issued by the multiplexer) or not
+        class DUT(Module):
+            def __init__(self, tfaw):
+                self.submodules.reference = tFAWController(tfaw)
+                self.submodules.incremental = tFAWController(tfaw, incremental=True)
+        for tfaw in [1, 2, 4, 5, 8, 17]:
+            for gated in [True, False]:
+                dut = DUT(tfaw)
+                mismatches = []
+                def generator():
+                    prng = random.Random(tfaw)
+                    for i in range(300):
+                        valid = prng.randrange(2)
+                        if gated:
+                            valid &= (yield dut.reference.ready)
+                        yield dut.reference.valid.eq(valid)
+                        yield dut.incremental.valid.eq(valid)
+                        yield
+                        if (yield dut.reference.ready) != (yield dut.incremental.ready):
+                            mismatches.append(i)
+                run_simulation(dut, generator())
+                self.assertEqual(mismatches, [])
+
+        # same commands issued by the controller
+        def run(settings):
+            dut = ControllerDUT(settings)
+            driver = PortDriver(dut.ports[0], random_accesses(32, 2**11))
+            run_simulation(dut, [dut.checker.generator()] + driver.generators())
+            self.assertEqual(driver.errors, 0)
+            self.assertEqual(dut.checker.violations, [])
+            return dut.checker.commands
+        self.assertEqual(run(ControllerSettings(with_incremental_tfaw=True)), run(ControllerSettings()))
+
+    def test_registered_steerer(self):
+        # same commands, one sys clk cycle later
+        configs = [
+            ({}, {}),
+            ({"refresh_mode": "rank"}, {"nranks": 2, "timings": {"tREFI": 64}}),
+            ({"with_multi_cmd": True}, {"phy_settings": get_sim_phy_settings_1_4()}),
+        ]
+        for settings_kwargs, dut_kwargs in configs:
+            commands = {}
+            for registered in [False, True]:
+                settings = ControllerSettings(with_registered_steerer=registered, **settings_kwargs)
+                dut_commands = []
+                errors, cycles = run_accesses(settings, [random_accesses(32, 2**9)],
+                    dut_callback=lambda dut: dut_commands.extend(dut.checker.commands), **dut_kwargs)
+                self.assertEqual(errors, 0)
+                commands[registered] = dut_commands
+            nphases = dut_kwargs.get("phy_settings", get_sim_phy_settings()).nphases
+            self.assertEqual(commands[True],
+                [(now + nphases, cmd, banks, address) for now, cmd, banks, address in commands[False]])
+
+        # read/write data latencies of the reorder/write data buffers
+        dut = ControllerDUT(ControllerSettings(with_registered_steerer=True), nports=0)
+        dut.ports = [dut.crossbar.get_port(reorder_depth=8, write_buffer_depth=8, write_forwarding=True)]
+        driver = PortDriver(dut.ports[0], random_accesses(64, 2**9))
+        run_simulation(dut, [dut.checker.generator()] + driver.generators())
+        self.assertEqual(driver.errors, 0)
+        self.assertEqual(dut.checker.violations, [])
+
+    def test_cmd_pool(self):
+        def run(settings, accesses):
+            dut = ControllerDUT(settings)
+            driver = PortDriver(dut.ports[0], accesses)
+            bank = dut.controller.interface.bank0
+            queued = [0, 0] # current, max
+            @passive
+            def monitor():
+                while True:
+                    if (yield bank.valid) and (yield bank.ready):
+                        queued[0] += 1
+                    if (yield bank.rdata_valid) or (yield bank.wdata_ready):
+                        queued[0] -= 1
+                    queued[1] = max(queued)
+                    yield
+            run_simulation(dut, [monitor(), dut.checker.generator()] + driver.generators())
+            self.assertEqual(driver.errors, 0)
+            self.assertEqual(dut.checker.violations, [])
+            return queued[1]
+
+        # random accesses, pool often full
+        for cmd_pool_depth in [4, 16]:
+            run(ControllerSettings(cmd_pool_depth=cmd_pool_depth), random_accesses(64, 2**11))
+
+        # hot bank (bank 0): the whole pool can be used by its queue
+        hot = [(i%2, ((i//4) << 5) | (i%8), i) for i in range(64)]
+        self.assertEqual(run(ControllerSettings(cmd_buffer_depth=2), hot), 2 + 1)
+        self.assertEqual(run(ControllerSettings(cmd_buffer_depth=2, cmd_pool_depth=16), hot), 16 + 2)
+
+        with self.assertRaises(ValueError):
+            ControllerDUT(ControllerSettings(cmd_pool_depth=16, with_frfcfs=True))
+
+    def test_bank_machine_virtualization(self):
+        # random accesses to all the banks with fewer bank machines than banks
+        for nbank_machines in [1, 3]:
+            settings = ControllerSettings(nbank_machines=nbank_machines)
+            errors, cycles = run_accesses(settings, [random_accesses(64, 2**13)])
+            self.assertEqual(errors, 0)
+        settings = ControllerSettings(nbank_machines=2)
+        errors, cycles = run_accesses(settings, [random_accesses(32, 2**13, seed=s) for s in [1, 2]])
+        self.assertEqual(errors, 0)
+
+        # per-rank refresh (bank machines bound to both ranks), DDR4 bank groups
+        settings = ControllerSettings(nbank_machines=3, refresh_mode="rank")
+        errors, cycles = run_accesses(settings, [random_accesses(64, 2**14)], {"tREFI": 64}, nranks=2)
+        self.assertEqual(errors, 0)
+        settings = ControllerSettings(nbank_machines=4)
+        errors, cycles = run_accesses(settings, [random_accesses(64, 2**13)],
+            phy_settings=get_sim_phy_settings_1_4(memtype="DDR4"), module_cls=SimModuleBankGroups)
+        self.assertEqual(errors, 0)
+
+        # accesses alternating between 2 banks with 1 bank machine: the open rows are
+        # restored from the table when the banks are bound again
+        accesses = [(i%2, ((5 + 2*(i%2)) << 5) | ((i%2) << 3) | (i%8), i) for i in range(32)]
+        commands = []
+        errors, cycles = run_accesses(ControllerSettings(nbank_machines=1), [accesses],
+            dut_callback=lambda dut: commands.extend(dut.checker.commands))
+        self.assertEqual(errors, 0)
+        self.assertEqual([c[1] for c in commands].count("ACT"), 2)
+        self.assertEqual([c[1] for c in commands].count("PRE"), 0)
+
+        with self.assertRaises(ValueError):
+            ControllerDUT(ControllerSettings(nbank_machines=8))
+
+    def test_burst_commands(self):
+        # commands of len+1 consecutive words, crossing rows/banks
+        prng = random.Random(42)
+        bursts = [(1, prng.randrange(2**13), prng.randrange(16)) for i in range(16)]
+        bursts += [(0, addr, length) for we, addr, length in bursts]
+        memory = {}
+        wdatas = []
+        rdatas = []
+        for we, addr, length in bursts:
+            for i in range(length + 1):
+                if we:
+                    memory[addr + i] = prng.randrange(2**16)
+                    wdatas.append(memory[addr + i])
+                else:
+                    rdatas.append(memory[addr + i])
+
+        dut = ControllerDUT(ControllerSettings(), nports=0)
+        port = dut.crossbar.get_port(len_bits=4)
+        errors = [0]
+        ncmds = [0]
+
+        def cmd_generator():
+            for we, addr, length in bursts:
+                yield port.cmd.valid.eq(1)
+                yield port.cmd.we.eq(we)
+                yield port.cmd.addr.eq(addr)
+                yield port.cmd.len.eq(length)
+                yield
+                while (yield port.cmd.ready) == 0:
+                    yield
+                ncmds[0] += 1
+            yield port.cmd.valid.eq(0)
+
+        def wdata_generator():
+            yield port.wdata.we.eq(2**len(port.wdata.we) - 1)
+            for data in wdatas:
+                yield port.wdata.valid.eq(1)
+                yield port.wdata.data.eq(data)
+                yield
+                while (yield port.wdata.ready) == 0:
+                    yield
+            yield port.wdata.valid.eq(0)
+
+        def rdata_generator():
+            yield port.rdata.ready.eq(1)
+            for data in rdatas:
+                yield
+                while (yield port.rdata.valid) == 0:
+                    yield
+                if (yield port.rdata.data) != data:
+                    errors[0] += 1
+
+        generators = [cmd_generator(), wdata_generator(), rdata_generator(), dut.checker.generator()]
+        run_simulation(dut, generators)
+        self.assertEqual(errors[0], 0)
+        self.assertEqual(ncmds[0], len(bursts))
+        self.assertEqual(dut.checker.violations, [])
+
+        with self.assertRaises(ValueError):
+            ControllerDUT(ControllerSettings(), nports=0).crossbar.get_port(data_width=64, len_bits=4)
@@ -0,0 +1,145 @@
+import unittest
+import random
+
+from migen import *
+
+from litedram.common import LiteDRAMNativePort
+from litedram.frontend.monitor import LiteDRAMNativePortLatencyMonitor
+
+from litex.gen.sim import *
+
+
+class DUT(Module):
+    def __init__(self, depth=32):
+        self.port_from = LiteDRAMNativePort("both", 24, 32)
+        self.port_to = LiteDRAMNativePort("both", 24, 32)
+        self.submodules.monitor = LiteDRAMNativePortLatencyMonitor(
+            self.port_from, self.port_to, depth=depth)
+
+
+def user_generator(port, accesses):
+    prng = random.Random(1)
+    for we in accesses:
+        yield port.cmd.valid.eq(1)
+        yield port.cmd.we.eq(we)
+        yield
+        while (yield port.cmd.ready) == 0:
+            yield
+        yield port.cmd.valid.eq(0)
+        for i in range(prng.randrange(3)):
+            yield
+
+
+def wdata_generator(port, nwrites):
+    for i in range(nwrites):
+        yield port.wdata.valid.eq(1)
+        yield
+        while (yield port.wdata.ready) == 0:
+            yield
+    yield port.wdata.valid.eq(0)
+
+
+def rdata_generator(port, nreads):
+    yield port.rdata.ready.eq(1)
+    for i in range(nreads):
+        yield
+        while (yield port.rdata.valid) == 0:
+            yield
+
+
+@passive
+def memory_generator(port):
+    # accepts the commands and returns the data of each access after a random delay
+    prng = random.Random(2)
+    yield port.cmd.ready.eq(1)
+    pending = []
+    while True:
+        yield port.rdata.valid.eq(0)
+        yield port.wdata.ready.eq(0)
+        if pending and pending[0][1] == 0:
+            if pending[0][0]:
+                yield port.wdata.ready.eq(1)
+                done = (yield port.wdata.valid)
+            else:
+                yield port.rdata.valid.eq(1)
+                done = (yield port.rdata.ready)
+            if done:
+                pending.pop(0)
+        pending = [(we, max(delay - 1, 0)) for we, delay in pending]
+        if (yield port.cmd.valid) and (yield port.cmd.ready):
+            pending.append(((yield port.cmd.we), prng.choice([0, 1, 2, 5, 20, 100])))
+        yield
+
+
+@passive
+def reference_generator(port, latencies):
+    # software model of the monitor
+    timestamps = {0: [], 1: []}
+    cycle = 0
+    while True:
+        if (yield port.cmd.valid) and (yield port.cmd.ready):
+            timestamps[(yield port.cmd.we)].append(cycle)
+        if (yield port.rdata.valid) and (yield port.rdata.ready):
+            latencies[0].append(cycle - timestamps[0].pop(0))
+        if (yield port.wdata.valid) and (yield port.wdata.ready):
+            latencies[1].append(cycle - timestamps[1].pop(0))
+        cycle += 1
+        yield
+
+
+class TestMonitor(unittest.TestCase):
+    def run_monitor(self, depth=32):
+        prng = random.Random(3)
+        accesses = [prng.randrange(2) for i in range(128)]
+        dut = DUT(depth)
+        latencies = {0: [], 1: []}
+        statistics = {}
+        def snapshot():
+            for i in range(4000):
+                yield
+            yield dut.monitor.snapshot.re.eq(1)
+            yield
+            yield dut.monitor.snapshot.re.eq(0)
+            yield
+            yield
+            for name in ["read", "write"]:
+                s = getattr(dut.monitor, name)
+                values = {"buckets": []}
+                for n in ["count", "total", "min", "max"]:
+                    values[n] = (yield getattr(s, n).status)
+                for i in range(16):
+                    values["buckets"].append((yield getattr(s, "bucket{}".format(i)).status))
+                statistics[name] = values
+        generators = [
+            user_generator(dut.port_from, accesses),
+            wdata_generator(dut.port_from, sum(accesses)),
+            rdata_generator(dut.port_from, len(accesses) - sum(accesses)),
+            memory_generator(dut.port_to),
+            reference_generator(dut.port_from, latencies),
+            snapshot()
+        ]
+        run_simulation(dut, generators)
+        self.assertEqual(len(latencies[0]) + len(latencies[1]), len(accesses))
+        return statistics, latencies
+
+    def check(self, statistics, latencies):
+        for name, we in [("read", 0), ("write", 1)]:
+            values = statistics[name]
+            self.assertEqual(values["count"], len(latencies[we]))
+            self.assertEqual(values["total"], sum(latencies[we]))
+            self.assertEqual(values["min"], min(latencies[we]))
+            self.assertEqual(values["max"], max(latencies[we]))
+            buckets = [0]*16
+            for latency in latencies[we]:
+                buckets[min(latency.bit_length(), 15)] += 1
+            self.assertEqual(values["buckets"], buckets)
+
+    def test_latency(self):
+        statistics, latencies = self.run_monitor()
+        self.assertGreater(max(latencies[0]), 64)
+        self.check(statistics, latencies)
+
+    def test_latency_stall(self):
+        # commands stalled by the full timestamps FIFOs: latencies are still matched
+        statistics, latencies = self.run_monitor(depth=2)
+        self.check(statistics, latencies)